@@ -1,30 +1,66 @@
 
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from flask_restful import Resource, Api
 from flask_cors import CORS
 from models import db, Plant, User
 from werkzeug.exceptions import NotFound, HTTPException
-from external_apis import get_plant_image, get_weather
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from flask_bcrypt import Bcrypt
+from external_apis import get_weather, get_weather_many
+from pagination import encode_cursor, decode_cursor, parse_limit
+from plant_queries import PLANT_FIELDS, parse_bool, parse_date, parse_fields, parse_sort, plant_filters, page_after, order_by, cursor_for
+from migrations import upgrade_db
+from etags import plant_etag, collection_state, collection_etag, etag_header, not_modified
+from bulk_import import NDJSON_TYPES, CSV_TYPES, read_ndjson, read_csv, import_plants
+from export import export_ndjson, export_csv
+from storage import configure_storage, init_storage, read_session
+from serializer import dumps, plant_columns, encode_plant, encode_plant_page, json_response
+from watering import watering_plan
+from events import hub, StreamFull, replay, event_stream
+from changes import TokenExpired, decode_token, changes_since, compact as compact_changes, deleted as plant_deleted
+from metrics import init_metrics, collect as collect_metrics
+from ratelimit import init_rate_limits
+from profiling import init_profiling
+from compression import init_compression
+from enrichment import enricher, PENDING, backfill as backfill_plant_images
+from passwords import hasher, HashingBusy
+from identity import load_user
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, current_user
+import click
+from datetime import timedelta
 import os
 
 app = Flask(__name__) #initalise flask app
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///plants.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite:///plants.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["PLANTS_PAGE_SIZE"] = int(os.getenv("PLANTS_PAGE_SIZE", 100)) #plants per page on GET /plants
+app.config["PLANTS_MAX_PAGE_SIZE"] = int(os.getenv("PLANTS_MAX_PAGE_SIZE", 1000)) #biggest limit a client can ask for
+app.config["BULK_BATCH_SIZE"] = int(os.getenv("BULK_BATCH_SIZE", 1000)) #rows per insert on POST /plants/bulk
+app.config["BULK_MAX_ERRORS"] = int(os.getenv("BULK_MAX_ERRORS", 1000)) #error lines listed in the bulk report
+app.config["EXPORT_CHUNK_SIZE"] = int(os.getenv("EXPORT_CHUNK_SIZE", 1000)) #rows fetched at a time by GET /plants/export
+app.config["WEATHER_BATCH_MAX_CITIES"] = int(os.getenv("WEATHER_BATCH_MAX_CITIES", 50)) #cities allowed in one /weather call
 
 
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", default=None)
 app.config['JWT_SECRET_KEY'] = os.getenv("JWT_SECRET_KEY", default=None) #uses envoirment variables for secret keys
 
 #initalise 
+configure_storage(app) #sqlite pragmas and pool settings, see storage.py
 db.init_app(app) #db
-bcrypt = Bcrypt(app)#password hashing
+hasher.init_app(app) #BCRYPT_LOG_ROUNDS and the hashing pool, see passwords.py
+enricher.init_app(app) #background image lookups, see enrichment.py
+hub.init_app(app) #GET /plants/stream subscribers, see events.py
 jwt = JWTManager(app)#jwt 
 
+@jwt.user_lookup_loader # user behind the token, cached, see identity.py
+def user_lookup(jwt_header, jwt_data):
+    return load_user(jwt_data["sub"])
+
 with app.app_context(): #create db id it doesnt exist
+    init_storage(app)
     db.create_all()
+    upgrade_db() #add anything newer than the existing db
 
 CORS(app, resources={r"*": {"origins": "*"}}, supports_credentials=True, expose_headers=["Authorization"])
 
@@ -39,20 +75,31 @@ def secure_headers(response): # secuirty headeder sent after every request
     response.headers['X-XSS-Protection'] = '1; mode=block' #XSS filter
     return response
 
+init_metrics(app) #request, sql and upstream timings, see metrics.py
+init_rate_limits(app) #token buckets per user, ip and upstream, see ratelimit.py
+init_profiling(app) #X-Profile header or PROFILE_SAMPLE_RATE, see profiling.py
+init_compression(app) #gzip/deflate for big json and csv bodies, see compression.py
+
+
+@app.errorhandler(HashingBusy) # hashing pool is full, tell the client to come back
+def hashing_busy(e):
+    return {'message': 'server is busy, please try again shortly'}, 503, {'Retry-After': str(hasher.retry_after)}
+
+
+@app.route('/metrics', methods=['GET']) # prometheus scrape endpoint
+def metrics():
+    return Response(collect_metrics(), mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/get_user', methods=['GET']) #get user endpoint for testing
 @jwt_required()
 def get_user():
-    user_id = get_jwt_identity()
-    user = User.query.filter_by(id=user_id).first()
+    user = current_user #loaded by user_lookup, a deleted user gets 401 before this runs
 
     # if not username or not email or not password:
     #     return {'message': 'Missing required fields'}, 400
 
-    if user:
-        return {'message': 'Sucess', 'name': user.username}, 200
-    else:
-        return {'message': 'Failed'}, 404
+    return {'message': 'Sucess', 'name': user.username}, 200
 
 
 
@@ -81,8 +128,10 @@ def register():
         return {"message":"password must have at least one uppercase letter."},400
     if not any(c.islower() for c in password):
         return {"message":"password must have at least one lowercase letter."},400
+    if len(password.encode('utf-8')) > 72:
+        return {"message":"password cant be longer than 72 bytes."},400 #bcrypt only uses the first 72
 
-    hashed_pw = bcrypt.generate_password_hash(password).decode('utf-8') #hash password before storing 
+    hashed_pw = hasher.hash(password) #hash password before storing, runs on the hashing pool
     user = User(username=username, email=email, password=hashed_pw)
     db.session.add(user)
     db.session.commit()
@@ -100,149 +149,337 @@ def login():
 
     user = User.query.filter_by(username=username).first()
 
-    if user and bcrypt.check_password_hash(user.password, password): #if user and password create JWT
+    if user and hasher.check(user.password, password): #if user and password create JWT
+        if hasher.needs_rehash(user.password): #BCRYPT_LOG_ROUNDS changed since this hash was made
+            try:
+                user.password = hasher.hash(password)
+                db.session.commit()
+            except HashingBusy:
+                pass #keep the old hash, tried again on the next login
         token = create_access_token(identity=str(user.id)) 
         return {'token': token}, 200
 
     return {'message': 'Invalid credentials'}, 401
 
 
+def validate_plant(data):
+    # checks a new plant, returns (column values, None) or (None, error message)
+    if not data.get('name'):
+        return None, 'please enter a plant name'
+
+    if not data.get('location'):
+        return None, 'please enter a location'
+
+    if not data.get('date_planted'):
+        return None, 'please enter a date'
+        #checks all feilds
+    try:
+        date_planted = parse_date(data['date_planted'])
+    except ValueError as e:
+        return None, str(e)
+
+    height = None #checks height
+    if data.get('height') is not None:
+        try: 
+            height = float(data.get('height'))
+        except (TypeError, ValueError):
+            return None, 'height must be a number'
+        if height < 0:
+            return None, 'height cant be negative'
+
+    return {
+        'name': data['name'],
+        'location': data.get('location'),
+        'date_planted': date_planted,
+        'height': height,
+        'watered': bool(data.get('watered', False)),
+        'notes': data.get('notes')
+    }, None
+
+
+def current_user_id():
+    return int(get_jwt_identity()) #identity is the users id, see login
+
+
+def owned_plant(session, plant_id):
+    # the callers plant with this id, None if it doesnt exist or belongs to someone else
+    return session.execute(
+        select(Plant).where(Plant.user_id == current_user_id(), Plant.id == plant_id) #uses ix_plant_user_id_id
+    ).scalar_one_or_none()
+
+
+STALE_RETRIES = 3 #times put/delete reload a plant whose version changed under them
+
+
+def edit_plant(plant, data):
+    # applies a put body to the plant, returns an error response or None
+    if 'name' in data:
+        plant.name = data['name']
+
+    if 'location' in data:
+        plant.location = data['location']
+
+    if 'date_planted' in data:
+        try:
+            plant.date_planted = parse_date(data['date_planted'])
+        except ValueError as e:
+            return {'message': str(e)}, 400
+        #update feild if change occured
+
+
+    height = plant.height #validates height
+    if data.get('height') is not None:
+        try: 
+            height = float(data.get('height'))
+            if height < 0:
+                return{'message': 'height cant be negative'}, 400
+        except ValueError:
+            return{'message': 'height must be a number'}, 400
+
+    plant.name = data.get('name', plant.name)
+    plant.location = data.get('location', plant.location)
+    plant.height = height
+    return None
+
+
 class PlantResource(Resource): #plant resource for CRUD
 
     @jwt_required()
     def get(self, plant_id=None): #gets plants
+        reader = read_session() #read only engine when SQLITE_READ_ENGINE is on
         if plant_id:
-            plant = Plant.query.get(plant_id)
+            plant = reader.execute( #plain row, no orm object
+                select(*plant_columns(PLANT_FIELDS, extra=['version'])).where(Plant.user_id == current_user_id(), Plant.id == plant_id)
+            ).first()
             if plant is None:
                 return{'message': f'Plant with id {plant_id} not found'}, 404
 
-            image_url = None
-            image_url = get_plant_image(plant.name) #get image from external API
-
-            return {
-                'id': plant.id,
-                'name': plant.name,
-                'location': plant.location,
-                'date_planted': plant.date_planted,
-                'height': plant.height,
-                'watered': plant.watered,
-                'notes': plant.notes,
-                'image_url': image_url
-            }
+            etag = plant_etag(plant)
+            unchanged = not_modified(etag) #client already has this version
+            if unchanged:
+                return unchanged
+
+            return json_response(encode_plant(plant, PLANT_FIELDS), 200, etag_header(etag)) #image_url is stored, no external call
         else:
-            plants = Plant.query.all()
-            if not plants:
-                return{'plants':[], 'message': 'no plants found'} #returns if no plants
-            return [
-                {
-                    'id': plant.id,
-                    'name': plant.name,
-                    'location': plant.location,
-                    'date_planted': plant.date_planted,
-                    'height': plant.height,
-                    'watered': plant.watered,
-                    'notes': plant.notes,
-                    'image_url': get_plant_image(plant.name)
-                }
-                for plant in plants
-            ]
+            try:
+                limit = parse_limit(request.args.get('limit'), app.config["PLANTS_PAGE_SIZE"], app.config["PLANTS_MAX_PAGE_SIZE"])
+                fields = parse_fields(request.args.get('fields'))
+                sort, descending = parse_sort(request.args.get('sort'))
+                filters = [Plant.user_id == current_user_id()] + plant_filters(request.args)
+                if request.args.get('cursor'):
+                    filters.append(page_after(sort, descending, decode_cursor(request.args['cursor'])))
+            except ValueError as e:
+                return {'message': str(e)}, 400
+
+            etag = collection_etag(collection_state(filters, reader), request.args)
+            unchanged = not_modified(etag)
+            if unchanged:
+                return unchanged
+
+            columns = plant_columns(fields, extra=['id', sort]) #the cursor is built from id and the sort column
+
+            # keyset pagination, only the requested columns come back as plain rows
+            rows = reader.execute(
+                select(*columns).where(*filters).order_by(*order_by(sort, descending)).limit(limit + 1)
+            ).all()
+            next_cursor = encode_cursor(cursor_for(sort, rows[limit - 1])) if len(rows) > limit else None
+            rows = rows[:limit]
+            if not rows:
+                return{'plants':[], 'message': 'no plants found', 'next_cursor': None}, 200, etag_header(etag) #returns if no plants
+
+            body = b"".join(encode_plant_page(rows, fields, next_cursor)) #encoded a plant at a time
+            return json_response(body, 200, etag_header(etag))
 
 
     @jwt_required()
     def post(self): #add plants
         data = request.get_json()
 
-        if not data.get('name'):
-            return{'message': 'please enter a plant name'}, 400
-
-        if not data.get('location'):
-            return{'message':'please enter a location'}, 400
-
-        if not data.get('date_planted'):
-            return{'message': 'please enter a date'}, 400
-            #checks all feilds
-
-        height = None #checks height
-        if data.get('height') is not None:
-            try: 
-                height = float(data.get('height'))
-                if height < 0:
-                    return{'message': 'height cant be negative'}, 400
-            except ValueError:
-                return{'message': 'height must be a number'}, 400
-
-
-        new_plant = Plant(
-            name=data['name'],
-            location=data.get('location'),
-            date_planted=data.get('date_planted'),
-            height=height,
-            watered=bool(data.get('watered', False)),
-            notes=data.get('notes')
-        )
+        values, error = validate_plant(data)
+        if error:
+            return {'message': error}, 400
+
+        new_plant = Plant(user_id=current_user_id(), **values)
         db.session.add(new_plant) #add to DB
         db.session.commit()
+        enricher.enqueue(new_plant.id, new_plant.name) #image is looked up in the background
         return {'message': 'plant added successfully'}, 201
 
 
     @jwt_required()
     def put(self, plant_id): #edit plant info
         data = request.get_json()
-        plant = Plant.query.get(plant_id) 
-        if not plant: 
-            return {'message': f'Plant with id {plant_id} not found'}, 404
-
-        if 'name' in data:
-            plant.name = data['name']
-
-        if 'location' in data:
-            plant.location = data['location']
-
-        if 'date_planted' in data:
-            plant.date_planted = data['date_planted']
-            #update feild if change occured
-
-
-        height = plant.height #validates height
-        if data.get('height') is not None:
-            try: 
-                height = float(data.get('height'))
-                if height < 0:
-                    return{'message': 'height cant be negative'}, 400
-            except ValueError:
-                return{'message': 'height must be a number'}, 400
-
-        plant.name = data.get('name', plant.name)
-        plant.location = data.get('location', plant.location)
-        plant.date_planted = data.get('date_planted', plant.date_planted)
-        plant.height = height
-        db.session.commit()
-        return {'message': 'plant updated successfully'}, 200
+        for attempt in range(STALE_RETRIES): #the image worker can write the row between loading and committing it
+            plant = owned_plant(db.session, plant_id)
+            if not plant: 
+                return {'message': f'Plant with id {plant_id} not found'}, 404
+            old_name = plant.name
+            error = edit_plant(plant, data)
+            if error:
+                db.session.rollback()
+                return error
+            renamed = plant.name != old_name
+            if renamed: #the old image is for the old name
+                plant.image_url = None
+                plant.image_status = PENDING
+            try:
+                db.session.commit()
+            except StaleDataError: #version moved on since the load, load it again and redo the edit
+                db.session.rollback()
+                continue
+            if renamed:
+                enricher.enqueue(plant.id, plant.name)
+            return {'message': 'plant updated successfully'}, 200
+        return {'message': 'plant is being changed, please try again'}, 409
 
 
     @jwt_required()
     def delete(self, plant_id):
-        plant = Plant.query.get(plant_id) 
-        if not plant: 
-            return {'message': f'Plant with id {plant_id} not found'}, 404
-        db.session.delete(plant)
-        db.session.commit()
-        return {'message': 'plant deleted successfully'}, 200
+        for attempt in range(STALE_RETRIES):
+            plant = owned_plant(db.session, plant_id)
+            if not plant: 
+                return {'message': f'Plant with id {plant_id} not found'}, 404
+            db.session.delete(plant)
+            try:
+                db.session.commit()
+            except StaleDataError:
+                db.session.rollback()
+                continue
+            plant_deleted() #the tombstone is written by a trigger, this just compacts now and then
+            return {'message': 'plant deleted successfully'}, 200
+        return {'message': 'plant is being changed, please try again'}, 409
+
+
+class PlantBulkResource(Resource): #streaming import of many plants
+
+    @jwt_required()
+    def post(self):
+        if request.mimetype in NDJSON_TYPES:
+            records = read_ndjson(request.stream)
+        elif request.mimetype in CSV_TYPES:
+            records = read_csv(request.stream)
+        else:
+            return {'message': 'send application/x-ndjson or text/csv'}, 415
+
+        report = import_plants(records, validate_plant, current_user_id(),
+                               batch_size=app.config["BULK_BATCH_SIZE"], max_errors=app.config["BULK_MAX_ERRORS"],
+                               on_inserted=enricher.enqueue_many) #images looked up in the background, a lookup per name
+        return report, 201 if report['inserted'] else 400
+
+
+class PlantExportResource(Resource): #streams every plant as ndjson or csv
+
+    @jwt_required()
+    def get(self):
+        try:
+            export_format = request.args.get('format', 'ndjson')
+            if export_format not in ('ndjson', 'csv'):
+                raise ValueError("format must be ndjson or csv")
+            with_images = parse_bool(request.args['images'], 'images') if request.args.get('images') else False #off by default
+            filters = [Plant.user_id == current_user_id()] + plant_filters(request.args)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        if export_format == 'csv':
+            body, mimetype = export_csv(filters, app.config["EXPORT_CHUNK_SIZE"], with_images), 'text/csv'
+        else:
+            body, mimetype = export_ndjson(filters, app.config["EXPORT_CHUNK_SIZE"], with_images), 'application/x-ndjson'
+        response = Response(stream_with_context(body), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename=plants.{export_format}'
+        return response
+
+
+class PlantChangesResource(Resource): #what changed since the clients last sync
+
+    @jwt_required()
+    def get(self):
+        try:
+            limit = parse_limit(request.args.get('limit'), app.config["PLANTS_PAGE_SIZE"], app.config["PLANTS_MAX_PAGE_SIZE"])
+            fields = parse_fields(request.args.get('fields'))
+            since = decode_token(request.args.get('since'))
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        try:
+            changes, token, has_more = changes_since(read_session(), current_user_id(), since, limit, fields)
+        except TokenExpired:
+            return {'message': 'since is too old, start again without it'}, 410
+        return json_response(dumps({'changes': changes, 'token': token, 'has_more': has_more}))
+
+
+class PlantStreamResource(Resource): #server sent events as plants change, in place of polling GET /plants
+
+    @jwt_required(locations=['headers', 'query_string']) #EventSource cant set headers, browsers send ?jwt=<token>
+    def get(self):
+        if not request.environ.get('wsgi.multithread'): #sync worker, a stream would hold the whole process, see events.py
+            return {'message': 'streaming needs a threaded or gevent server, poll /plants/changes instead'}, 503
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') #header on reconnect, query for the first connect
+        if last_event_id is not None:
+            if not last_event_id.isdigit():
+                return {'message': 'Last-Event-ID must be an event id from this stream'}, 400
+            last_event_id = int(last_event_id)
+
+        session = read_session()
+        try:
+            subscriber = hub.subscribe(current_user_id(), session) #before the replay so nothing falls between the two
+        except StreamFull:
+            return {'message': 'too many open streams, please try again shortly'}, 503, {'Retry-After': '30'}
+        missed = replay(session, subscriber, current_user_id(), last_event_id, app.config["STREAM_REPLAY_LIMIT"])
+        # no stream_with_context, the body only reads its queue and shouldnt hold a request context open for hours
+        body = event_stream(subscriber, missed, app.config["STREAM_HEARTBEAT"], app.config["STREAM_RETRY_MS"])
+        response = Response(body, mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache, no-transform'
+        response.headers['X-Accel-Buffering'] = 'no' #nginx would otherwise hold events back
+        return response
+
+
+class WateringPlanResource(Resource): #which plants to water, weather fetched once per location
+
+    @jwt_required()
+    def get(self):
+        try:
+            limit = parse_limit(request.args.get('limit'), app.config["PLANTS_PAGE_SIZE"], app.config["PLANTS_MAX_PAGE_SIZE"])
+            filters = [Plant.user_id == current_user_id()] + plant_filters(request.args)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        plants, totals, weather = watering_plan(read_session(), filters, limit)
+        return json_response(dumps({
+            'plants': [dict(row._mapping) for row in plants], #most in need first
+            'totals': {recommendation: totals.get(recommendation, 0) for recommendation in ('water', 'check', 'skip')},
+            'weather': {location: info for location, info in weather.items() if 'error' not in info},
+            'errors': {location: info['error'] for location, info in weather.items() if 'error' in info},
+        }))
 
 
 @app.route("/weather/<string:city>", methods=["GET"]) #reoute to check weathrt 
 def weather(city):
-    if app.config.get("TESTING"):
-        if city.lower() == "dublin":    
-            return {"temp":16, "condition":"sunny"},200 #return mock datatype
-        else:
-            return {"message":"city not found"},404
-     
     weather_info = get_weather(city)
     if "error" in weather_info:
         return weather_info, 404
     return weather_info, 200
 
+@app.route("/weather", methods=["GET", "POST"]) #weather for many cities at once
+def weather_many():
+    if request.method == "POST":
+        cities = (request.get_json(silent=True) or {}).get("cities")
+        if not isinstance(cities, list) or not all(isinstance(city, str) for city in cities):
+            return {"message": "cities must be a list of city names"}, 400
+    else:
+        cities = request.args.get("cities", "").split(",") # ?cities=dublin,cork
+
+    cities = [city.strip() for city in cities if city.strip()]
+    if not cities:
+        return {"message": "please enter at least one city"}, 400
+    if len(cities) > app.config["WEATHER_BATCH_MAX_CITIES"]:
+        return {"message": f"at most {app.config['WEATHER_BATCH_MAX_CITIES']} cities per request"}, 400
+
+    results = get_weather_many(cities)
+    return {
+        "weather": {city: info for city, info in results.items() if "error" not in info},
+        "errors": {city: info["error"] for city, info in results.items() if "error" in info},
+    }, 200
+
 @app.route("/image/<string:plant>", methods=["GET"])
 def image_test_fucntion(plant):
     if app.config.get("TESTING"):
@@ -257,12 +494,46 @@ def image_test_fucntion(plant):
 # Routes
 api = Api(app)
 api.add_resource(PlantResource, '/plants', '/plants/<int:plant_id>')
+api.add_resource(PlantBulkResource, '/plants/bulk')
+api.add_resource(PlantExportResource, '/plants/export')
+api.add_resource(WateringPlanResource, '/plants/watering-plan')
+api.add_resource(PlantChangesResource, '/plants/changes')
+api.add_resource(PlantStreamResource, '/plants/stream')
 
 @app.route('/')
 def home():
     return {'message': 'Welcome'}
 
 
+@app.cli.command("assign-plants") # flask --app app assign-plants <username>
+@click.argument("username")
+def assign_plants(username):
+    """give plants created before ownership existed to a user"""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"no user called {username}")
+    count = Plant.query.filter(Plant.user_id.is_(None)).update({Plant.user_id: user.id}, synchronize_session=False)
+    db.session.commit()
+    click.echo(f"{count} plants now belong to {username}")
+
+
+@app.cli.command("compact-changes") # flask --app app compact-changes --days 30
+@click.option("--days", type=float, default=None, help="keep tombstones this many days, CHANGES_RETENTION_DAYS by default")
+def compact_change_log(days):
+    """drop old tombstones from the change log"""
+    removed = compact_changes(timedelta(days=days) if days is not None else None)
+    click.echo(f"{removed} tombstones removed")
+
+
+@app.cli.command("backfill-images") # flask --app app backfill-images
+@click.option("--batch-size", default=500, help="plants looked up at a time")
+@click.option("--skip-failed", is_flag=True, help="leave plants whose lookup already failed alone")
+def backfill_images(batch_size, skip_failed):
+    """look up images for plants that dont have one stored yet"""
+    updated, missing = backfill_plant_images(batch_size, retry_failed=not skip_failed)
+    click.echo(f"{updated} plants updated, {missing} still without an answer from unsplash")
+
+
 # @app.errorhandler(HTTPException)
 # def handle_http_exception(e):
 #     return {'message': e.description}, e.code
@@ -0,0 +1,214 @@
+"""endpoint benchmarks against seeded databases, with the external apis stubbed
+
+    PYTHONPATH=. python bench/bench_endpoints.py --sizes 1000,10000,100000 --output bench.json
+    PYTHONPATH=. python bench/bench_endpoints.py --baseline bench.json --tolerance 1.25
+
+every request goes through the flask test client. unsplash, nominatim and
+openweathermap are answered by the local fake upstream from tests/ with
+--upstream-latency ms added to each call. prints (or writes) json with
+throughput and p50/p95/p99 in ms per endpoint and table size. with
+--baseline, any p50 or p95 more than --tolerance times the stored value is
+reported and the exit code is 1. rate limiting is off unless --rate-limit is
+given, the bench sends far more requests a second than any one client may
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+_tmp = tempfile.mkdtemp(prefix="plant-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp, 'bench.db')}")
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+os.environ.setdefault("JWT_SECRET_KEY", "bench-jwt-secret")
+
+from flask_jwt_extended import create_access_token  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+import external_apis  # noqa: E402
+from app import app, db  # noqa: E402
+from migrations import upgrade_db  # noqa: E402
+from passwords import hasher  # noqa: E402
+from models import Plant, User, utcnow  # noqa: E402
+from fake_upstream import FakeUpstream  # noqa: E402
+
+LOCATIONS = ["Dublin", "Cork", "Galway", "Limerick", "Kildare"]
+NAMES = ["Rose", "Lily", "Oak", "Fern", "Tulip", "Daisy", "Ivy", "Mint", "Basil", "Cactus"]
+PASSWORD = "BenchPass123"
+SLOW_ENDPOINTS = ("register", "login") #bcrypt bound, fewer samples
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def seed(size):
+    db.drop_all()
+    db.create_all()
+    upgrade_db() #change log triggers, as on startup
+    user = User(username="bench", email="bench@bench.com", password=hasher.hash(PASSWORD))
+    db.session.add(user)
+    db.session.commit()
+    now = utcnow()
+    for start in range(0, size, 5000):
+        db.session.execute(insert(Plant), [
+            {"name": f"{random.choice(NAMES)} {i % 50}", "location": random.choice(LOCATIONS),
+             "date_planted": date(2025, 11, 9), "height": round(random.random() * 100, 1), "watered": random.random() < 0.5,
+             "notes": "seeded for benchmarks", "user_id": user.id, "version": 1, "updated_at": now}
+            for i in range(start, min(size, start + 5000))
+        ])
+        db.session.commit()
+    return user.id
+
+
+def endpoint_calls(client, size, headers):
+    # name -> (function making one request, expected status)
+    counter = {"register": 0, "posted": []}
+
+    def register():
+        counter["register"] += 1
+        return client.post("/register", json={"username": f"u{size}x{counter['register']}",
+                                              "email": f"u{size}x{counter['register']}@bench.com",
+                                              "password": PASSWORD})
+
+    def plant_post():
+        response = client.post("/plants", json={"name": "Bench plant", "location": random.choice(LOCATIONS),
+                                                "date_planted": "09-11-2025", "height": 5}, headers=headers)
+        counter["posted"].append(size + len(counter["posted"]) + 1)
+        return response
+
+    def plant_delete():
+        return client.delete(f"/plants/{counter['posted'].pop()}", headers=headers)
+
+    return {
+        "register": (register, 201),
+        "login": (lambda: client.post("/login", json={"username": "bench", "password": PASSWORD}), 200),
+        "plants_list": (lambda: client.get("/plants", headers=headers), 200),
+        "plants_list_filtered": (lambda: client.get(
+            f"/plants?location={random.choice(LOCATIONS)}&sort=-height&fields=name,location", headers=headers), 200),
+        "plant_get": (lambda: client.get(f"/plants/{random.randint(1, size)}", headers=headers), 200),
+        "plant_post": (plant_post, 201),
+        "plant_put": (lambda: client.put(f"/plants/{random.randint(1, size)}",
+                                         json={"height": round(random.random() * 100, 1)}, headers=headers), 200),
+        "plant_delete": (plant_delete, 200), #deletes what plant_post added so the size stays put
+        "weather": (lambda: client.get(f"/weather/{random.choice(LOCATIONS)}"), 200),
+    }
+
+
+def measure(call, expected, requests):
+    timings = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        response = call()
+        timings.append((time.perf_counter() - t0) * 1000)
+        if response.status_code != expected:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+    }
+
+
+def run(sizes, requests, slow_requests, upstream, rate_limit=False):
+    app.config["RATE_LIMIT_ENABLED"] = rate_limit #left on, most requests would just time a 429
+    for city in LOCATIONS:
+        upstream.cities[city.lower()] = (50 + LOCATIONS.index(city), -8.0, f"{city}, Ireland")
+    results = {}
+    with app.app_context():
+        for size in sizes:
+            user_id = seed(size)
+            for cache in (external_apis.image_cache, external_apis.geocode_cache, external_apis.weather_cache):
+                cache.clear()
+            with app.test_request_context():
+                headers = {"Authorization": f"Bearer {create_access_token(identity=str(user_id))}"}
+            client = app.test_client()
+            results[str(size)] = {
+                name: measure(call, expected, slow_requests if name in SLOW_ENDPOINTS else requests)
+                for name, (call, expected) in endpoint_calls(client, size, headers).items()
+            }
+            print(f"size {size} done", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # list of regressions, compares p50 and p95 of every endpoint both runs have
+    regressions = []
+    for size, endpoints in results.items():
+        for name, stats in endpoints.items():
+            before = baseline.get("results", {}).get(size, {}).get(name)
+            if not before:
+                continue
+            for metric in ("p50_ms", "p95_ms"):
+                if before[metric] and stats[metric] > before[metric] * tolerance:
+                    regressions.append({"size": size, "endpoint": name, "metric": metric,
+                                        "baseline": before[metric], "current": stats[metric],
+                                        "ratio": round(stats[metric] / before[metric], 2)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated plant counts")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint and size")
+    parser.add_argument("--slow-requests", type=int, default=10, help="requests for register and login")
+    parser.add_argument("--upstream-latency", type=float, default=50, help="ms added to every stubbed api call")
+    parser.add_argument("--rate-limit", action="store_true", help="keep the per user and per ip rate limits on")
+    parser.add_argument("--output", help="write the json here instead of stdout")
+    parser.add_argument("--baseline", help="json from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slowdown ratio against the baseline")
+    args = parser.parse_args()
+
+    random.seed(1234)
+    upstream = FakeUpstream()
+    upstream.delay = args.upstream_latency / 1000
+    upstream.start()
+    external_apis.use_upstreams(upstream.url, upstream.url, upstream.url)
+    try:
+        results = run([int(size) for size in args.sizes.split(",")], args.requests, args.slow_requests, upstream,
+                      args.rate_limit)
+    finally:
+        upstream.stop()
+        with app.app_context():
+            db.engine.dispose()
+        shutil.rmtree(_tmp, ignore_errors=True)
+
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(),
+                 "requests": args.requests, "upstream_latency_ms": args.upstream_latency,
+                 "rate_limit": args.rate_limit},
+        "results": results,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
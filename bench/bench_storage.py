@@ -0,0 +1,125 @@
+"""mixed read/write throughput on plants.db with and without the storage profile
+
+    PYTHONPATH=. python bench/bench_storage.py --readers 4 --writers 2 --seconds 5
+
+each reader and writer is its own process like a gunicorn worker. prints one
+json document with ops/s and lock errors for the "default" run (sqlalchemy
+defaults) and the "tuned" run (storage.py pragmas, pool and read engine)
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert, select, update  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from models import Plant, create_change_log, utcnow  # noqa: E402
+import storage  # noqa: E402
+
+LOCATIONS = ["Dublin", "Cork", "Galway", "Limerick", "Kildare"]
+
+
+def make_engine(url, profile, read_only=False):
+    if profile == "default":
+        return create_engine(url)
+    config = {}
+    storage.load_config(config)
+    engine = create_engine(url, **storage.engine_options(config, url))
+    storage.install_pragmas(engine, storage.sqlite_pragmas(config), read_only=read_only)
+    return engine
+
+
+def seed(url, profile, rows):
+    engine = make_engine(url, profile)
+    Plant.metadata.create_all(engine)
+    with engine.begin() as conn:
+        create_change_log(conn) #the triggers every plant write pays for in the app
+        conn.execute(insert(Plant), [
+            {"name": f"Plant {i}", "location": random.choice(LOCATIONS), "date_planted": date(2025, 11, 9),
+             "height": random.random() * 100, "watered": False, "notes": "seeded", "version": 1, "updated_at": utcnow()}
+            for i in range(rows)
+        ])
+    engine.dispose()
+
+
+def reader(url, profile, seconds, rows, results):
+    engine = make_engine(url, profile, read_only=True)
+    ops = errors = 0
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        after = random.randint(0, rows)
+        try:
+            with engine.connect() as conn:
+                conn.execute(select(Plant.id, Plant.name, Plant.location)
+                             .where(Plant.id > after).order_by(Plant.id).limit(100)).all()
+            ops += 1
+        except OperationalError:
+            errors += 1
+    results.put(("read", ops, errors))
+
+
+def writer(url, profile, seconds, rows, results):
+    engine = make_engine(url, profile)
+    ops = errors = 0
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        try:
+            with engine.begin() as conn:
+                if random.random() < 0.5:
+                    conn.execute(insert(Plant).values(name="New plant", location=random.choice(LOCATIONS),
+                                                      date_planted=date(2025, 11, 9), version=1, updated_at=utcnow()))
+                else:
+                    conn.execute(update(Plant).where(Plant.id == random.randint(1, rows))
+                                 .values(height=random.random() * 100, updated_at=utcnow()))
+            ops += 1
+        except OperationalError:
+            errors += 1
+    results.put(("write", ops, errors))
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'plants.db')}"
+        seed(url, profile, args.rows)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=reader, args=(url, profile, args.seconds, args.rows, results))
+                   for _ in range(args.readers)]
+        workers += [multiprocessing.Process(target=writer, args=(url, profile, args.seconds, args.rows, results))
+                    for _ in range(args.writers)]
+        for worker in workers:
+            worker.start()
+        totals = {"read": [0, 0], "write": [0, 0]}
+        for _ in workers:
+            kind, ops, errors = results.get()
+            totals[kind][0] += ops
+            totals[kind][1] += errors
+        for worker in workers:
+            worker.join()
+    return {
+        "reads_per_second": round(totals["read"][0] / args.seconds, 1),
+        "writes_per_second": round(totals["write"][0] / args.seconds, 1),
+        "read_errors": totals["read"][1],
+        "write_errors": totals["write"][1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+    report = {"config": vars(args), "default": run("default", args), "tuned": run("tuned", args)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import csv
+import io
+import json
+from sqlalchemy import insert
+from models import db, Plant
+from plant_queries import parse_bool
+
+# POST /plants/bulk reads the body one line at a time and inserts in batches,
+# so memory use depends on the batch size and not on the size of the upload
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonlines')
+CSV_TYPES = ('text/csv', 'application/csv')
+
+
+def _text_stream(stream):
+    return io.TextIOWrapper(io.BufferedReader(stream), encoding='utf-8', errors='replace', newline='')
+
+
+def read_ndjson(stream):
+    # yields (line number, dict) or (line number, error message)
+    for line_no, line in enumerate(_text_stream(stream), start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield line_no, 'invalid json'
+            continue
+        if not isinstance(data, dict):
+            yield line_no, 'each line must be a json object'
+            continue
+        yield line_no, data
+
+
+def read_csv(stream):
+    # same as read_ndjson, the first line is the header so rows start at line 2
+    reader = csv.DictReader(_text_stream(stream))
+    for row in reader:
+        data = {key: value for key, value in row.items() if key and value not in (None, '')}
+        if 'watered' in data:
+            try:
+                data['watered'] = parse_bool(data['watered'])
+            except ValueError:
+                yield reader.line_num, 'watered must be true or false'
+                continue
+        yield reader.line_num, data
+
+
+def import_plants(records, validate, user_id, batch_size=1000, max_errors=1000, on_inserted=None):
+    # validates every record and inserts the good ones for user_id with one executemany per batch.
+    # on_inserted gets the (id, name) rows of each batch once it is committed
+    report = {'inserted': 0, 'failed': 0, 'errors': []}
+    batch = []
+
+    def flush():
+        if batch:
+            rows = db.session.execute(insert(Plant).returning(Plant.id, Plant.name), batch).all()
+            db.session.commit() #short transactions, other writers get a turn between batches
+            report['inserted'] += len(batch)
+            batch.clear()
+            if on_inserted is not None:
+                on_inserted(rows)
+
+    for line_no, data in records:
+        error = data if isinstance(data, str) else None
+        if error is None:
+            values, error = validate(data)
+        if error:
+            report['failed'] += 1
+            if len(report['errors']) < max_errors: #the report itself stays bounded
+                report['errors'].append({'line': line_no, 'message': error})
+            continue
+        values['user_id'] = user_id
+        batch.append(values)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return report
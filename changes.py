@@ -0,0 +1,104 @@
+import os
+from datetime import timedelta
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, Plant, PlantChange, ChangeHorizon, utcnow
+from pagination import BadCursor, encode_cursor, decode_cursor
+from serializer import plant_dict
+
+# GET /plants/changes?since=<token>. the token is the last seq the client has
+# seen, the answer is every plant of theirs changed after it (current state,
+# or a tombstone for a delete) read off ix_plant_change_user_seq. tombstones
+# older than CHANGES_RETENTION_DAYS are compacted away, a token from before
+# that gets 410 and the client starts again from a full sync
+
+RETENTION_DAYS = float(os.getenv("CHANGES_RETENTION_DAYS", 30))
+COMPACT_EVERY = int(os.getenv("CHANGES_COMPACT_EVERY", 1000)) #deletes between automatic compactions, per process
+
+
+class TokenExpired(Exception):
+    pass
+
+
+def encode_token(seq):
+    return encode_cursor([seq])
+
+
+def decode_token(token):
+    # None or "" means from the start
+    if not token:
+        return 0
+    values = decode_cursor(token)
+    if len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+        raise BadCursor("invalid since token")
+    return values[0]
+
+
+def horizon(session):
+    return session.execute(select(ChangeHorizon.seq).where(ChangeHorizon.id == 1)).scalar() or 0
+
+
+def changes_since(session, user_id, since, limit, fields):
+    # (changes after since in seq order, token to pass next time, more waiting)
+    if since and since < horizon(session):
+        raise TokenExpired()
+    # the newest seq is read first and the range stops there, so an empty page can hand it
+    # out as the token: anything committed after this read gets a bigger seq (one writer at a time)
+    top = session.execute(select(func.max(PlantChange.seq))).scalar() or 0
+    # a plants 'create' row stays put when it is updated, the later 'upsert' carries the same current state
+    later = aliased(PlantChange)
+    updated = select(later.seq).where(
+        later.plant_id == PlantChange.plant_id, later.user_id == PlantChange.user_id, later.op == 'upsert', later.seq <= top
+    ).exists()
+    rows = session.execute(
+        select(PlantChange.seq, PlantChange.plant_id, PlantChange.op, *[getattr(Plant, field) for field in fields])
+        .select_from(PlantChange)
+        .outerjoin(Plant, (Plant.id == PlantChange.plant_id) & (PlantChange.op != 'delete'))
+        .where(PlantChange.user_id == user_id, PlantChange.seq > since, PlantChange.seq <= top)
+        .where((PlantChange.op != 'create') | ~updated)
+        .order_by(PlantChange.seq).limit(limit + 1)
+    ).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    changes = [
+        {'id': row.plant_id, 'deleted': True} if row.op == 'delete'
+        else {'id': row.plant_id, 'deleted': False, 'plant': plant_dict(row, fields)}
+        for row in rows
+    ]
+    if rows:
+        token = encode_token(rows[-1].seq)
+    else: #nothing new up to top, the client can carry on from there
+        token = encode_token(max(since, top))
+    return changes, token, has_more
+
+
+def compact(older_than=None):
+    # drops tombstones older than the retention and moves the horizon past them, returns how many went
+    cutoff = utcnow() - (older_than if older_than is not None else timedelta(days=RETENTION_DAYS))
+    with db.engine.begin() as connection:
+        last = connection.execute(
+            select(func.max(PlantChange.seq)).where(PlantChange.op == 'delete', PlantChange.changed_at < cutoff)
+        ).scalar()
+        if last is None:
+            return 0
+        removed = connection.execute(
+            delete(PlantChange).where(PlantChange.op == 'delete', PlantChange.seq <= last)
+        ).rowcount
+        stmt = sqlite_insert(ChangeHorizon).values(id=1, seq=last)
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=[ChangeHorizon.id], set_={"seq": func.max(ChangeHorizon.seq, stmt.excluded.seq)},
+        ))
+    return removed
+
+
+_deletes = 0
+
+
+def deleted():
+    # called after a plant is deleted, compacts every COMPACT_EVERY deletes
+    global _deletes
+    _deletes += 1
+    if _deletes >= COMPACT_EVERY:
+        _deletes = 0
+        compact()
@@ -0,0 +1,72 @@
+import os
+import zlib
+from flask import current_app, request
+
+# gzip / deflate for json, ndjson and csv responses, done in after_request.
+# small bodies are sent as they are, streamed bodies are compressed chunk by
+# chunk as they go out. a strong ETag gets the encoding appended so the
+# compressed and plain bodies never share one
+
+ENCODINGS = ("gzip", "deflate")
+_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS} #http deflate is the zlib format
+
+
+def load_config(config):
+    defaults = {
+        "COMPRESS_MIN_SIZE": int(os.getenv("COMPRESS_MIN_SIZE", 1024)), #bytes, smaller bodies arent worth it
+        "COMPRESS_LEVEL": int(os.getenv("COMPRESS_LEVEL", 6)), #1 fastest .. 9 smallest
+        "COMPRESS_MIMETYPES": {"application/json", "application/x-ndjson", "text/csv", "text/plain"},
+    }
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+
+def encoded_etag(etag, encoding):
+    return f"{etag}-{encoding}"
+
+
+def _stream(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH) #client gets each chunk as soon as it is made
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close() #lets stream_with_context clean up
+
+
+def compress_response(response):
+    config = current_app.config
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.mimetype not in config["COMPRESS_MIMETYPES"]
+            or "Content-Encoding" in response.headers or response.direct_passthrough
+            or "no-transform" in response.headers.get("Cache-Control", "")):
+        return response
+    response.vary.add("Accept-Encoding") #caches must keep a copy per encoding
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None or request.method == "HEAD":
+        return response
+
+    compressor = zlib.compressobj(config["COMPRESS_LEVEL"], zlib.DEFLATED, _WBITS[encoding])
+    if response.is_streamed:
+        response.response = _stream(response.response, compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESS_MIN_SIZE"]:
+            return response
+        response.set_data(compressor.compress(data) + compressor.flush())
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(encoded_etag(etag, encoding))
+    return response
+
+
+def init_compression(app):
+    load_config(app.config)
+    app.after_request(compress_response)
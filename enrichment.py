@@ -0,0 +1,170 @@
+import heapq
+import os
+import threading
+import time
+import requests
+from sqlalchemy import select, update
+import external_apis
+from models import db, Plant, utcnow
+
+# images are looked up off the read path. post and put (when the name changes)
+# queue a lookup, a background thread fetches it with retries and writes
+# image_url and image_status on the plant. GET only reads the stored column.
+# with IMAGE_ENRICH_INLINE (tests) the lookup runs in the calling thread instead
+
+PENDING = "pending" #not looked up yet, or the name changed
+DONE = "done" #looked up, image_url can still be None when unsplash has nothing
+FAILED = "failed" #gave up after every retry, the backfill command tries again
+
+
+def load_config(config):
+    defaults = {
+        "IMAGE_ENRICH_INLINE": os.getenv("IMAGE_ENRICH_INLINE", "false").lower() in ("1", "true", "yes"),
+        "IMAGE_ENRICH_WORKERS": int(os.getenv("IMAGE_ENRICH_WORKERS", 2)), #background threads per process
+        "IMAGE_ENRICH_RETRIES": int(os.getenv("IMAGE_ENRICH_RETRIES", 4)), #attempts after the first one
+        "IMAGE_ENRICH_BACKOFF": float(os.getenv("IMAGE_ENRICH_BACKOFF", 2)), #seconds before the first retry, doubles each time
+    }
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+
+def save_image(connection, plant_ids, name, image_url, status=DONE):
+    # only rows still called name are touched, a rename in the meantime has queued its own lookup
+    result = connection.execute(
+        update(Plant.__table__)
+        .where(Plant.id.in_(plant_ids), Plant.name == name)
+        .values(image_url=image_url, image_status=status, version=Plant.version + 1, updated_at=utcnow())
+    )
+    return result.rowcount
+
+
+def enrich_plant(plant_ids, name):
+    # one attempt for every plant called name, raises requests.RequestException or ValueError when unsplash couldnt answer
+    found, image_url = external_apis.lookup_cached_image(name)
+    if not found:
+        image_url = external_apis.fetch_plant_image(name)
+        external_apis.store_plant_image(name, image_url)
+    with db.engine.begin() as connection:
+        save_image(connection, plant_ids, name, image_url)
+
+
+class ImageEnricher:
+
+    def __init__(self):
+        self.app = None
+        self._jobs = [] #heap of (due, sequence, plant_ids, name, attempt)
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def init_app(self, app):
+        load_config(app.config)
+        self.app = app
+
+    def enqueue(self, plant_id, name):
+        self._enqueue((plant_id,), name)
+
+    def enqueue_many(self, plants):
+        # (id, name) pairs, plants with the same name share one lookup
+        ids_by_name = {}
+        for plant_id, name in plants:
+            ids_by_name.setdefault(name, []).append(plant_id)
+        for name, plant_ids in ids_by_name.items():
+            self._enqueue(tuple(plant_ids), name)
+
+    def _enqueue(self, plant_ids, name):
+        if self.app.config["IMAGE_ENRICH_INLINE"]:
+            self._run_inline(plant_ids, name)
+            return
+        self._schedule(time.monotonic(), plant_ids, name, 0)
+        self._start_threads()
+
+    def pending(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def _schedule(self, due, plant_ids, name, attempt):
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._jobs, (due, self._sequence, plant_ids, name, attempt))
+            self._condition.notify()
+
+    def _start_threads(self):
+        # started on first use so each gunicorn worker gets its own after the fork
+        with self._condition:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.app.config["IMAGE_ENRICH_WORKERS"]:
+                thread = threading.Thread(target=self._work, name="image-enricher", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._jobs:
+                    wait = self._jobs[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self._jobs)
+                else:
+                    wait = None
+                self._condition.wait(wait)
+
+    def _work(self):
+        while True:
+            _, _, plant_ids, name, attempt = self._next_job()
+            with self.app.app_context():
+                try:
+                    enrich_plant(plant_ids, name)
+                except (requests.RequestException, ValueError) as e:
+                    self._retry(plant_ids, name, attempt, e)
+                except Exception as e:
+                    print(f"Image enrichment for plants {list(plant_ids)} crashed: {e}") #keep the thread alive
+
+    def _retry(self, plant_ids, name, attempt, error):
+        if attempt >= self.app.config["IMAGE_ENRICH_RETRIES"]:
+            print(f"Giving up on an image for plants {list(plant_ids)}: {error}")
+            with db.engine.begin() as connection:
+                save_image(connection, plant_ids, name, None, status=FAILED)
+            return
+        delay = self.app.config["IMAGE_ENRICH_BACKOFF"] * 2 ** attempt
+        self._schedule(time.monotonic() + delay, plant_ids, name, attempt + 1)
+
+    def _run_inline(self, plant_ids, name):
+        for attempt in range(self.app.config["IMAGE_ENRICH_RETRIES"] + 1): #no sleeping between attempts
+            try:
+                enrich_plant(plant_ids, name)
+                return
+            except (requests.RequestException, ValueError) as e:
+                error = e
+        self._retry(plant_ids, name, self.app.config["IMAGE_ENRICH_RETRIES"], error)
+
+
+enricher = ImageEnricher()
+
+
+def backfill(batch_size=500, retry_failed=True):
+    # looks up images for every plant that doesnt have one yet, a batch of names at a time.
+    # returns (plants updated, plants still missing an answer)
+    statuses = [PENDING, FAILED] if retry_failed else [PENDING]
+    updated = missing = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Plant.id, Plant.name).where(Plant.image_status.in_(statuses), Plant.id > last_id)
+            .order_by(Plant.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return updated, missing
+        last_id = rows[-1].id
+        ids_by_name = {}
+        for row in rows:
+            ids_by_name.setdefault(row.name, []).append(row.id)
+
+        external_apis.resolve_plant_images(ids_by_name) #fetches misses in parallel and fills the image cache
+        with db.engine.begin() as connection:
+            for name, plant_ids in ids_by_name.items():
+                found, image_url = external_apis.lookup_cached_image(name) #None from resolve can mean an error, the cache knows
+                if found:
+                    updated += save_image(connection, plant_ids, name, image_url)
+                else:
+                    missing += len(plant_ids)
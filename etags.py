@@ -0,0 +1,41 @@
+import hashlib
+from flask import Response, request
+from sqlalchemy import func, select
+from werkzeug.http import quote_etag
+from models import db, Plant
+from compression import ENCODINGS, encoded_etag
+
+# conditional GET for plants, a matching If-None-Match gets a 304 before any
+# serialisation or image lookups happen
+
+
+def plant_etag(plant):
+    return f"plant-{plant.id}-v{plant.version}"
+
+
+def collection_state(filters=(), session=None):
+    # changes whenever a matching plant is added, edited or deleted
+    session = session or db.session
+    count, last_id, last_update = session.execute(
+        select(func.count(Plant.id), func.max(Plant.id), func.max(Plant.updated_at)).where(*filters)
+    ).one()
+    return f"{count}:{last_id}:{last_update}"
+
+
+def collection_etag(state, args):
+    # the same data asked for with other filters or another page is another representation
+    query = "&".join(f"{key}={value}" for key, value in sorted(args.items(multi=True)))
+    digest = hashlib.sha1(f"{state}|{query}".encode("utf-8")).hexdigest()[:20]
+    return f"plants-{digest}"
+
+
+def etag_header(etag):
+    return {'ETag': quote_etag(etag)}
+
+
+def not_modified(etag):
+    # 304 response if the client already has this version, plain or compressed, otherwise None
+    for candidate in (etag,) + tuple(encoded_etag(etag, encoding) for encoding in ENCODINGS):
+        if request.if_none_match.contains_weak(candidate):
+            return Response(status=304, headers=etag_header(candidate))
+    return None
@@ -0,0 +1,222 @@
+import os
+import queue
+import threading
+import time
+from sqlalchemy import func, select
+from models import Plant, PlantChange
+from plant_queries import PLANT_FIELDS
+from serializer import dumps, plant_dict
+from changes import horizon
+from storage import read_session
+
+# GET /plants/stream, server sent events for plant creates, updates and deletes.
+# the plant_change table (written by triggers, see models.py) is the relay between
+# gunicorn workers: one thread per process polls it for new seqs and hands each
+# event to the bounded queues of that users subscribers. a subscriber that falls
+# STREAM_QUEUE_SIZE events behind is dropped and reconnects with Last-Event-ID,
+# the event id is the change seq so it picks up from plant_change where it left off.
+#
+# an open stream holds its thread until the client goes away, so it needs a server
+# that runs many requests per process: gunicorn --worker-class gthread --threads N
+# (keep STREAM_MAX_SUBSCRIBERS well under N) or a gevent worker. the default sync
+# worker would give one dashboard a whole worker, streams are refused with 503 there
+
+
+def load_config(config):
+    defaults = {
+        "STREAM_POLL_INTERVAL": float(os.getenv("STREAM_POLL_INTERVAL", 1)), #seconds between reads of plant_change
+        "STREAM_HEARTBEAT": float(os.getenv("STREAM_HEARTBEAT", 15)), #seconds of quiet before a comment line is sent
+        "STREAM_QUEUE_SIZE": int(os.getenv("STREAM_QUEUE_SIZE", 100)), #events a subscriber can be behind before it is dropped
+        "STREAM_REPLAY_LIMIT": int(os.getenv("STREAM_REPLAY_LIMIT", 1000)), #events resent on resume, past that the client is told to reload
+        "STREAM_MAX_SUBSCRIBERS": int(os.getenv("STREAM_MAX_SUBSCRIBERS", 50)), #open streams per process, under the threads it has
+        "STREAM_RETRY_MS": int(os.getenv("STREAM_RETRY_MS", 3000)), #how long browsers wait before reconnecting
+    }
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+
+class StreamFull(Exception):
+    pass
+
+
+def format_event(kind, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {kind}", "data: " + dumps(data).decode("utf-8")]
+    return "\n".join(lines) + "\n\n"
+
+
+def _event(row):
+    # (seq, user_id, sse text) for a plant_change row joined to its plant
+    if row.op == 'delete' or row.id is None: #plant gone since, a later delete row is on its way
+        return row.seq, row.user_id, format_event('delete', {'id': row.plant_id}, row.seq)
+    kind = 'create' if row.op == 'create' else 'update'
+    return row.seq, row.user_id, format_event(kind, {'id': row.plant_id, 'plant': plant_dict(row, PLANT_FIELDS)}, row.seq)
+
+
+def events_after(session, seq, limit, user_id=None):
+    # changes after seq in order, every users when user_id is None. walks the plant_change
+    # primary key, or ix_plant_change_user_seq for one user
+    query = (
+        select(PlantChange.seq, PlantChange.plant_id, PlantChange.user_id, PlantChange.op,
+               *[getattr(Plant, field) for field in PLANT_FIELDS])
+        .select_from(PlantChange)
+        .outerjoin(Plant, (Plant.id == PlantChange.plant_id) & (PlantChange.op != 'delete'))
+        .where(PlantChange.seq > seq)
+        .order_by(PlantChange.seq).limit(limit)
+    )
+    if user_id is not None:
+        query = query.where(PlantChange.user_id == user_id)
+    return [_event(row) for row in session.execute(query).all()]
+
+
+def last_seq(session):
+    return session.execute(select(func.max(PlantChange.seq))).scalar() or 0
+
+
+class Subscriber:
+
+    def __init__(self, user_id, size):
+        self.user_id = user_id
+        self.queue = queue.Queue(size)
+        self.after = 0 #live events at or below this were already sent by the replay
+        self.dropped = False
+
+
+class EventHub:
+
+    def __init__(self):
+        self.app = None
+        self.seq = None #newest seq handed out, None while nobody is listening
+        self._subscribers = {} #user_id: set of Subscriber
+        self._count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        load_config(app.config)
+        self.app = app
+
+    def subscribe(self, user_id, session):
+        with self._lock:
+            if self._count >= self.app.config["STREAM_MAX_SUBSCRIBERS"]:
+                raise StreamFull()
+            if self.seq is None: #first listener, start from now rather than replay the log for nobody
+                self.seq = last_seq(session)
+            subscriber = Subscriber(user_id, self.app.config["STREAM_QUEUE_SIZE"])
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+            self._count += 1
+        self._start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id, set())
+            if subscriber in subscribers:
+                subscribers.discard(subscriber)
+                self._count -= 1
+            if not subscribers:
+                self._subscribers.pop(subscriber.user_id, None)
+            if not self._count:
+                self.seq = None
+
+    def subscribers(self):
+        with self._lock:
+            return self._count
+
+    def publish(self, user_id, seq, text):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait((seq, text))
+            except queue.Full:
+                self._drop(subscriber)
+
+    def _drop(self, subscriber):
+        # the slow client gets an end of stream marker in place of its backlog, its browser
+        # reconnects with Last-Event-ID and catches up from plant_change
+        self.unsubscribe(subscriber)
+        subscriber.dropped = True
+        while True:
+            try:
+                subscriber.queue.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.queue.put_nowait(None)
+
+    def poll(self, session, batch_size=1000):
+        # one read of plant_change, returns how many events went out
+        sent = 0
+        while True:
+            with self._lock:
+                seq = self.seq
+            if seq is None:
+                return sent
+            events = events_after(session, seq, batch_size)
+            for event_seq, user_id, text in events:
+                self.publish(user_id, event_seq, text)
+            with self._lock:
+                if events and self.seq is not None:
+                    self.seq = max(self.seq, events[-1][0])
+            sent += len(events)
+            if len(events) < batch_size:
+                return sent
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="plant-events", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.app.config["STREAM_POLL_INTERVAL"])
+            if not self.subscribers():
+                continue
+            try:
+                with self.app.app_context():
+                    self.poll(read_session())
+            except Exception: #keep polling, the next pass reads from the same seq
+                self.app.logger.exception("reading plant_change for the event stream failed")
+
+
+hub = EventHub()
+
+
+def replay(session, subscriber, user_id, last_event_id, limit):
+    # events the client missed since last_event_id, or a reload event when they are
+    # no longer all in plant_change (compacted, or more than limit of them)
+    if last_event_id is None:
+        return []
+    if last_event_id < horizon(session):
+        return [format_event('reload', {'message': 'too far behind, fetch /plants again'})]
+    events = events_after(session, last_event_id, limit + 1, user_id)
+    if len(events) > limit:
+        subscriber.after = last_seq(session)
+        return [format_event('reload', {'message': 'too far behind, fetch /plants again'})]
+    if events:
+        subscriber.after = events[-1][0]
+    return [text for _, _, text in events]
+
+
+def event_stream(subscriber, missed, heartbeat, retry_ms):
+    # body of GET /plants/stream, runs until the client goes away or is dropped
+    try:
+        yield f"retry: {retry_ms}\n\n"
+        for text in missed:
+            yield text
+        while True:
+            try:
+                item = subscriber.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": heartbeat\n\n" #keeps proxies from timing out, and finds closed connections
+                continue
+            if item is None:
+                yield format_event('dropped', {'message': 'too slow, reconnect with Last-Event-ID'})
+                return
+            seq, text = item
+            if seq > subscriber.after:
+                yield text
+    finally:
+        hub.unsubscribe(subscriber)
@@ -0,0 +1,38 @@
+import csv
+import io
+from sqlalchemy import select
+from models import db, Plant
+from serializer import dumps, plant_dict
+
+# GET /plants/export streams the table out in chunks fetched with yield_per,
+# only one chunk of rows is ever held in memory. images are the stored image_url
+
+EXPORT_COLUMNS = ('id', 'name', 'location', 'date_planted', 'height', 'watered', 'notes')
+
+
+def _chunks(filters, chunk_size, with_images):
+    names = EXPORT_COLUMNS + (('image_url',) if with_images else ())
+    columns = [getattr(Plant, name) for name in names]
+    result = db.session.execute(
+        select(*columns).where(*filters).order_by(Plant.id).execution_options(yield_per=chunk_size)
+    )
+    for rows in result.partitions():
+        yield [plant_dict(row, names) for row in rows]
+
+
+def export_ndjson(filters, chunk_size=1000, with_images=False):
+    for plants in _chunks(filters, chunk_size, with_images):
+        yield b"".join(dumps(plant) + b"\n" for plant in plants)
+
+
+def export_csv(filters, chunk_size=1000, with_images=False):
+    header = EXPORT_COLUMNS + (('image_url',) if with_images else ())
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=header)
+    writer.writeheader()
+    yield buffer.getvalue()
+    for plants in _chunks(filters, chunk_size, with_images):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(plants)
+        yield buffer.getvalue()
@@ -1,32 +1,266 @@
 
+import asyncio
+import contextvars
 import requests
+import http_client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait
 from geopy.geocoders import Nominatim
+from geopy.exc import GeopyError
+from flask import current_app, has_app_context
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from cache import TTLCache
+from models import db, ImageCache, GeocodeCache, utcnow
 
 import os
 #api keys from evoirment variable
 
 image_api_key = os.getenv("image_api_key", default=None)
 
-def get_plant_image(plant_name):
-    url = f"https://api.unsplash.com/search/photos?query={plant_name}&client_id={image_api_key}"
-    response = requests.get(url).json()
-    if response.get('results'):
-        return response['results'][0]['urls']['regular'] #get first response 
+# upstream base urls, point them at a local stub server to test without the internet
+UNSPLASH_URL = os.getenv("UNSPLASH_URL", "https://api.unsplash.com")
+OPENWEATHER_URL = os.getenv("OPENWEATHER_URL", "https://api.openweathermap.org")
+NOMINATIM_URL = os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org")
+
+# image lookups are cached in memory (per worker) and in the image_cache table (shared)
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", 7 * 24 * 3600)) #seconds a found image is kept
+IMAGE_CACHE_NEGATIVE_TTL = int(os.getenv("IMAGE_CACHE_NEGATIVE_TTL", 3600)) #seconds a "no image" answer is kept
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", 2048)) #max names held in memory
+
+IMAGE_LOOKUP_WORKERS = int(os.getenv("IMAGE_LOOKUP_WORKERS", 8)) #max unsplash calls in flight per worker
+IMAGE_LOOKUP_DEADLINE = float(os.getenv("IMAGE_LOOKUP_DEADLINE", 3.0)) #seconds a list request waits for images
+
+# weather goes city -> coordinates (cached for a long time) -> current weather (cached briefly)
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", 30 * 24 * 3600)) #cities dont move
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", 24 * 3600)) #seconds a "not a city" answer is kept
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", 4096))
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", 600)) #seconds current weather is reused
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", 1024))
+WEATHER_GRID_DECIMALS = int(os.getenv("WEATHER_GRID_DECIMALS", 2)) #coordinate rounding for weather cache keys
+WEATHER_BATCH_CONCURRENCY = int(os.getenv("WEATHER_BATCH_CONCURRENCY", 8)) #cities looked up at once by get_weather_many
+WEATHER_BATCH_TIMEOUT = float(os.getenv("WEATHER_BATCH_TIMEOUT", 10)) #seconds before one city in a batch is given up on
+WEATHER_LOOKUP_WORKERS = int(os.getenv("WEATHER_LOOKUP_WORKERS", 32)) #threads shared by every get_weather_many call
+
+image_cache = TTLCache(maxsize=IMAGE_CACHE_SIZE, ttl=IMAGE_CACHE_TTL)
+geocode_cache = TTLCache(maxsize=GEOCODE_CACHE_SIZE, ttl=GEOCODE_CACHE_TTL)
+weather_cache = TTLCache(maxsize=WEATHER_CACHE_SIZE, ttl=WEATHER_CACHE_TTL)
+
+
+def make_geolocator(user_agent):
+    # nominatim client that goes through the shared http_client pool
+    url = urlsplit(NOMINATIM_URL)
+    return Nominatim(user_agent=user_agent, domain=url.netloc, scheme=url.scheme,
+                     adapter_factory=http_client.PooledGeopyAdapter)
+
+
+geolocator = make_geolocator("weather_app") #one geolocator for the whole process
+_image_pool = ThreadPoolExecutor(max_workers=IMAGE_LOOKUP_WORKERS, thread_name_prefix="image-lookup")
+# long lived, a lookup that times out finishes here in the background instead of
+# holding up asyncio.run, which waits for its own default executor on the way out
+_weather_pool = ThreadPoolExecutor(max_workers=WEATHER_LOOKUP_WORKERS, thread_name_prefix="weather-lookup")
+_MISS = object()
+
+
+def use_upstreams(unsplash_url=None, openweather_url=None, nominatim_url=None):
+    # repoint the upstreams at runtime, used by tests with a local stub server
+    global UNSPLASH_URL, OPENWEATHER_URL, NOMINATIM_URL, geolocator
+    UNSPLASH_URL = unsplash_url or UNSPLASH_URL
+    OPENWEATHER_URL = openweather_url or OPENWEATHER_URL
+    NOMINATIM_URL = nominatim_url or NOMINATIM_URL
+    geolocator = make_geolocator("weather_app")
+
+
+def _image_key(plant_name):
+    return " ".join(plant_name.lower().split())[:80] #"Rose ", "rose" and "ROSE" share an entry
+
+
+def _image_ttl(image_url):
+    return IMAGE_CACHE_TTL if image_url else IMAGE_CACHE_NEGATIVE_TTL
+
+
+def lookup_cached_image(plant_name):
+    # returns (found, image_url), found is False when unsplash has to be asked
+    key = _image_key(plant_name)
+    image_url = image_cache.get(key, _MISS)
+    if image_url is not _MISS:
+        return True, image_url
+
+    if not has_app_context(): #no db outside of flask
+        return False, None
+
+    row = db.session.get(ImageCache, key)
+    if row is None:
+        return False, None
+    remaining = _image_ttl(row.image_url) - (utcnow() - row.fetched_at).total_seconds()
+    if remaining <= 0: #stale, refetch
+        return False, None
+    image_cache.set(key, row.image_url, ttl=remaining) #warm this worker
+    return True, row.image_url
+
+
+def store_plant_image(plant_name, image_url):
+    key = _image_key(plant_name)
+    image_cache.set(key, image_url, ttl=_image_ttl(image_url))
+    if not has_app_context():
+        return
+
+    # own connection so the callers session and transaction are left alone
+    stmt = sqlite_insert(ImageCache).values(query_key=key, image_url=image_url, fetched_at=utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ImageCache.query_key],
+        set_={"image_url": stmt.excluded.image_url, "fetched_at": stmt.excluded.fetched_at},
+    )
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def fetch_plant_image(plant_name):
+    # always asks unsplash, raises requests.RequestException if it could not answer
+    response = http_client.get(
+        f"{UNSPLASH_URL}/search/photos",
+        params={"query": plant_name, "client_id": image_api_key},
+    )
+    response.raise_for_status() #dont treat quota or auth errors as "no image"
+    data = response.json()
+    if data.get('results'):
+        return data['results'][0]['urls']['regular'] #get first response 
     return None
 
 
-def get_weather(city_name):
-    geolocator = Nominatim(user_agent="weather_app")
+def get_plant_image(plant_name):
+    found, image_url = lookup_cached_image(plant_name)
+    if found:
+        return image_url
+
+    try:
+        image_url = fetch_plant_image(plant_name)
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error fetching image: {e}")
+        return None #not cached so the next request tries again
+
+    store_plant_image(plant_name, image_url)
+    return image_url
+
+
+def _remember_late_image(plant_name, future):
+    # finished after the deadline, keep it in memory so the next request has it
+    if not future.cancelled() and future.exception() is None:
+        store_plant_image(plant_name, future.result())
+
+
+def resolve_plant_images(plant_names, deadline=None):
+    # looks up images for many plants at once, returns {name: image_url}
+    # each distinct name is fetched once and misses run in parallel on _image_pool,
+    # anything not back before the deadline comes back as None
+    deadline = IMAGE_LOOKUP_DEADLINE if deadline is None else deadline
+    names_by_key = {}
+    for name in plant_names:
+        names_by_key.setdefault(_image_key(name), []).append(name)
+
+    images_by_key = {}
+    futures = {}
+    for key, names in names_by_key.items():
+        found, image_url = lookup_cached_image(names[0])
+        if found:
+            images_by_key[key] = image_url
+        else:
+            futures[_image_pool.submit(contextvars.copy_context().run, fetch_plant_image, names[0])] = key #keeps the callers context, see profiling.py
+
+    done, not_done = wait(futures, timeout=deadline)
+    for future in done:
+        key = futures[future]
+        try:
+            image_url = future.result()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error fetching image: {e}")
+            continue
+        store_plant_image(names_by_key[key][0], image_url)
+        images_by_key[key] = image_url
+    for future in not_done:
+        name = names_by_key[futures[future]][0]
+        future.add_done_callback(lambda f, name=name: _remember_late_image(name, f))
+
+    return {
+        name: images_by_key.get(key)
+        for key, names in names_by_key.items()
+        for name in names
+    }
+
+
+
+def city_key(city_name):
+    return " ".join(city_name.lower().split())[:120]
+
+
+def _geocode_ttl(place):
+    return GEOCODE_CACHE_TTL if place else GEOCODE_NEGATIVE_TTL
+
+
+def store_geocode(city_name, place):
+    key = city_key(city_name)
+    geocode_cache.set(key, place, ttl=_geocode_ttl(place))
+    if not has_app_context():
+        return
+
+    values = {"found": place is not None, "latitude": None, "longitude": None, "display_name": None, "fetched_at": utcnow()}
+    if place:
+        values.update(latitude=place["latitude"], longitude=place["longitude"], display_name=place["name"])
+    stmt = sqlite_insert(GeocodeCache).values(query_key=key, **values)
+    stmt = stmt.on_conflict_do_update(index_elements=[GeocodeCache.query_key], set_=values)
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def geocode_city(city_name):
+    # {"latitude", "longitude", "name"} or None when it isnt a place,
+    # raises GeopyError when nominatim could not answer
+    key = city_key(city_name)
+    place = geocode_cache.get(key, _MISS)
+    if place is not _MISS:
+        return place
+
+    if has_app_context():
+        row = db.session.get(GeocodeCache, key)
+        if row is not None:
+            place = {"latitude": row.latitude, "longitude": row.longitude, "name": row.display_name} if row.found else None
+            remaining = _geocode_ttl(place) - (utcnow() - row.fetched_at).total_seconds()
+            if remaining > 0:
+                geocode_cache.set(key, place, ttl=remaining)
+                return place
 
     location = geolocator.geocode(city_name) #checks if city
-    if not location:
+    place = None
+    if location:
+        place = {"latitude": location.latitude, "longitude": location.longitude, "name": location.address}
+    store_geocode(city_name, place)
+    return place
+
+
+def _weather_key(place):
+    # nearby lookups share an entry, 2 decimals is roughly 1km
+    return (round(place["latitude"], WEATHER_GRID_DECIMALS), round(place["longitude"], WEATHER_GRID_DECIMALS))
+
+
+def get_weather(city_name):
+    try:
+        place = geocode_city(city_name)
+    except GeopyError as e:
+        print(f"Error geocoding city: {e}")
+        return {"error": "Something went wrong, please try again."}
+    if not place:
         return {"error": f"'{city_name}' is not a valid city."}
 
+    key = _weather_key(place)
+    weather = weather_cache.get(key)
+    if weather is not None:
+        return dict(weather)
+
     weather_api_key = os.getenv("weather_api_key", default=None)
-    url = f"http://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={weather_api_key}&units=metric"
+    url = f"{OPENWEATHER_URL}/data/2.5/weather"
+    params = {"lat": place["latitude"], "lon": place["longitude"], "appid": weather_api_key, "units": "metric"}
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url, params=params)
         data = response.json()
 
         if response.status_code == 200 and data.get("main"):
@@ -36,7 +270,8 @@ def get_weather(city_name):
                 "temperature": data["main"]["temp"],
                 "description": data["weather"][0]["description"],
             }
-            return weather
+            weather_cache.set(key, weather)
+            return dict(weather)
         else:
             return {"error": "Weather data not available for this city."}
 
@@ -45,7 +280,37 @@ def get_weather(city_name):
         return {"error": "Something went wrong, please try again."}
 
 
+def _weather_in_app(app, city_name):
+    if app is None:
+        return get_weather(city_name)
+    with app.app_context(): #own app context so this thread gets its own db session
+        return get_weather(city_name)
+
+
+async def _gather_weather(app, city_names, concurrency, timeout):
+    limit = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
 
+    async def one(city_name):
+        async with limit:
+            try:
+                weather = await asyncio.wait_for(loop.run_in_executor(_weather_pool, _weather_in_app, app, city_name), timeout)
+            except asyncio.TimeoutError:
+                weather = {"error": "Timed out fetching weather."}
+        return city_name, weather
 
+    return dict(await asyncio.gather(*(one(city_name) for city_name in city_names)))
 
 
+def get_weather_many(city_names, concurrency=None, timeout=None):
+    # {city: get_weather(city)} for each distinct city, looked up concurrently on an event loop
+    unique = {}
+    for city_name in city_names:
+        unique.setdefault(city_key(city_name), city_name)
+    app = current_app._get_current_object() if has_app_context() else None
+    return asyncio.run(_gather_weather(
+        app,
+        list(unique.values()),
+        concurrency or WEATHER_BATCH_CONCURRENCY,
+        timeout or WEATHER_BATCH_TIMEOUT,
+    ))
@@ -0,0 +1,115 @@
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from geopy.adapters import AdapterHTTPError, BaseSyncAdapter
+from geopy.exc import GeocoderParseError, GeocoderServiceError, GeocoderTimedOut, GeocoderUnavailable
+
+# every outbound call goes through one requests.Session so connections are
+# pooled per host and kept alive, and nothing can wait forever on an upstream
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05)) #seconds to open a connection
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10)) #seconds to wait for the response
+POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", 10)) #hosts with their own pool
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20)) #kept alive connections per host
+CONNECT_RETRIES = int(os.getenv("HTTP_CONNECT_RETRIES", 1)) #only retried if nothing was sent
+
+
+def build_session():
+    session = requests.Session()
+    retries = Retry(total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0, status=0, other=0)
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = build_session()
+
+
+def get_session():
+    return _session
+
+
+def set_session(session):
+    # swap the shared session (tests), returns the old one
+    global _session
+    previous, _session = _session, session
+    return previous
+
+
+_listeners = []
+
+
+def add_listener(listener):
+    # listener(url, seconds, status, error) is called after every outbound call, error is None on success
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+_gates = []
+
+
+def add_gate(gate):
+    # gate(url) is called before every outbound call and can raise a requests.RequestException to stop it
+    _gates.append(gate)
+
+
+def remove_gate(gate):
+    _gates.remove(gate)
+
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    for gate in _gates:
+        gate(url)
+    started = time.perf_counter()
+    try:
+        response = _session.get(url, **kwargs)
+    except requests.RequestException as e:
+        _notify(url, time.perf_counter() - started, None, e)
+        raise
+    _notify(url, time.perf_counter() - started, response.status_code, None)
+    return response
+
+
+def _notify(url, seconds, status, error):
+    for listener in _listeners:
+        listener(url, seconds, status, error)
+
+
+class PooledGeopyAdapter(BaseSyncAdapter):
+    # lets geopy geocoders use the shared session instead of opening their own
+
+    def get_text(self, url, *, timeout, headers):
+        return self._request(url, headers=headers).text
+
+    def get_json(self, url, *, timeout, headers):
+        response = self._request(url, headers=headers)
+        try:
+            return response.json()
+        except ValueError:
+            raise GeocoderParseError(f"Could not deserialize using deserializer:\n{response.text}")
+
+    def _request(self, url, *, headers):
+        # geopys own timeout is ignored, ours from the environment is used
+        try:
+            response = get(url, headers=headers)
+        except requests.Timeout:
+            raise GeocoderTimedOut("Service timed out")
+        except requests.ConnectionError as e:
+            raise GeocoderUnavailable(str(e))
+        except requests.RequestException as e:
+            raise GeocoderServiceError(str(e))
+        if response.status_code >= 400:
+            raise AdapterHTTPError(
+                f"Non-successful status code {response.status_code}",
+                status_code=response.status_code,
+                headers=response.headers,
+                text=response.text,
+            )
+        return response
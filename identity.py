@@ -0,0 +1,37 @@
+import os
+from collections import namedtuple
+from sqlalchemy import event, select
+from cache import TTLCache
+from models import db, User
+
+# the user behind a jwt, cached so authenticated requests dont query the user
+# table every time. the cache holds plain tuples, not orm objects, so nothing
+# is tied to the session of the request that loaded it
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300)) #seconds, also how long another worker can see an old record
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+UserRecord = namedtuple("UserRecord", ["id", "username", "email"])
+
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def load_user(user_id):
+    # UserRecord for this id, None if the user doesnt exist (not cached, so a new user is found straight away)
+    user_id = int(user_id)
+    record = user_cache.get(user_id)
+    if record is None:
+        row = db.session.execute(select(User.id, User.username, User.email).where(User.id == user_id)).first()
+        if row is None:
+            return None
+        record = UserRecord(*row)
+        user_cache.set(user_id, record)
+    return record
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _forget_user(mapper, connection, target):
+    # any write through the orm drops the cached record, bulk query.update() doesnt fire this
+    user_cache.pop(target.id)
@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import http_client
+
+# request, sql and upstream metrics in prometheus text format at /metrics.
+# each worker keeps its numbers in memory and, when METRICS_DIR is set, writes
+# them to METRICS_DIR/metrics-<pid>.json every few seconds. /metrics adds up
+# every file so the numbers cover all gunicorn workers
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+METRICS_DIR = os.getenv("METRICS_DIR") #shared by all workers, unset means this process only
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5)) #seconds between writes to METRICS_DIR
+
+
+class Registry:
+    # counters and histograms keyed by metric name and a tuple of label pairs
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def declare(self, name, kind, help_text, buckets=None):
+        self._metrics[name] = {"type": kind, "help": help_text, "buckets": list(buckets or ()), "samples": {}}
+
+    def inc(self, name, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._metrics[name]["samples"]
+            samples[key] = samples.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = tuple(sorted(labels.items()))
+        metric = self._metrics[name]
+        index = bisect_left(metric["buckets"], value)
+        with self._lock:
+            sample = metric["samples"].get(key)
+            if sample is None:
+                sample = metric["samples"][key] = [0] * (len(metric["buckets"]) + 3) #buckets, +Inf, sum, count
+            sample[index] += 1
+            sample[-2] += value
+            sample[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: dict(metric, samples=[[list(key), value if isinstance(value, (int, float)) else list(value)]
+                                            for key, value in metric["samples"].items()])
+                for name, metric in self._metrics.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric["samples"].clear()
+
+
+registry = Registry()
+registry.declare("http_request_duration_seconds", "histogram", "Time spent handling a request.", LATENCY_BUCKETS)
+registry.declare("http_requests_total", "counter", "Requests handled.")
+registry.declare("sql_statements_per_request", "histogram", "SQL statements run by one request.", COUNT_BUCKETS)
+registry.declare("sql_duration_seconds_per_request", "histogram", "Time one request spent in SQL.", LATENCY_BUCKETS)
+registry.declare("sql_statements_total", "counter", "SQL statements run, in or out of a request.")
+registry.declare("upstream_request_duration_seconds", "histogram", "Time spent on calls to external apis.", LATENCY_BUCKETS)
+registry.declare("upstream_errors_total", "counter", "Calls to external apis that failed or returned 5xx.")
+
+
+def merge(snapshots):
+    # adds up snapshots from several workers into one
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for key, value in metric["samples"]:
+                key = tuple(tuple(pair) for pair in key)
+                if isinstance(value, list):
+                    current = target["samples"].get(key) or [0] * len(value)
+                    target["samples"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target["samples"][key] = target["samples"].get(key, 0) + value
+    return merged
+
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def render(merged):
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric["samples"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-2]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(key)} {value[-2]}")
+            lines.append(f"{name}_count{_labels(key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+_last_flush = 0.0
+
+
+def flush(force=False):
+    # writes this workers numbers to METRICS_DIR, at most every FLUSH_INTERVAL seconds
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = now
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(path + ".tmp", path) #readers never see half a file
+
+
+def collect():
+    # prometheus text for every worker (or just this one without METRICS_DIR)
+    if not METRICS_DIR:
+        return render(merge([registry.snapshot()]))
+    flush(force=True)
+    snapshots = []
+    for filename in os.listdir(METRICS_DIR):
+        if filename.startswith("metrics-") and filename.endswith(".json"):
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue #worker is mid write or gone
+    return render(merge(snapshots))
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+
+def _after_request(response):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+    endpoint = request.endpoint or "unknown"
+    labels = {"endpoint": endpoint, "method": request.method, "status": str(response.status_code)}
+    registry.observe("http_request_duration_seconds", {"endpoint": endpoint, "method": request.method},
+                     time.perf_counter() - started)
+    registry.inc("http_requests_total", labels)
+    registry.observe("sql_statements_per_request", {"endpoint": endpoint}, g.get("sql_statements", 0))
+    registry.observe("sql_duration_seconds_per_request", {"endpoint": endpoint}, g.get("sql_seconds", 0.0))
+    flush()
+    return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_started"].pop()
+    registry.inc("sql_statements_total", {})
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+
+
+@event.listens_for(Engine, "handle_error")
+def _sql_failed(context):
+    if context.connection is not None and context.connection.info.get("metrics_started"):
+        context.connection.info["metrics_started"].pop()
+
+
+def _upstream_call(url, seconds, status, error):
+    host = urlsplit(url).netloc
+    registry.observe("upstream_request_duration_seconds", {"host": host}, seconds)
+    if error is not None or (status is not None and status >= 500):
+        registry.inc("upstream_errors_total", {"host": host})
+
+
+def init_metrics(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    http_client.add_listener(_upstream_call)
@@ -0,0 +1,129 @@
+from datetime import datetime
+from sqlalchemy import inspect, literal, not_, select, update
+from sqlalchemy.schema import CreateIndex
+from models import db, Plant, PlantChange, create_change_log, create_plant_search, utcnow
+from plant_queries import format_date
+
+# create_all only makes missing tables, these steps bring an existing plants.db
+# up to date with models.py. every step checks first so running it again is a no-op
+
+
+def _has_column(connection, table, column):
+    return any(info["name"] == column for info in inspect(connection).get_columns(table))
+
+
+def _add_plant_versioning(connection):
+    if not _has_column(connection, "plant", "version"):
+        connection.exec_driver_sql("ALTER TABLE plant ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    if not _has_column(connection, "plant", "updated_at"):
+        connection.exec_driver_sql("ALTER TABLE plant ADD COLUMN updated_at DATETIME")
+        connection.execute(Plant.__table__.update().values(updated_at=utcnow()))
+
+
+def _add_plant_owner(connection):
+    if not _has_column(connection, "plant", "user_id"):
+        # existing plants have no owner until assign-plants is run
+        connection.exec_driver_sql("ALTER TABLE plant ADD COLUMN user_id INTEGER REFERENCES user (id)")
+    for name in ("ix_plant_updated_at", "ix_plant_name", "ix_plant_name_lower", "ix_plant_location",
+                 "ix_plant_height", "ix_plant_watered"):
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}") #replaced by the per user indexes
+
+
+def _add_plant_image(connection):
+    if not _has_column(connection, "plant", "image_url"):
+        connection.exec_driver_sql("ALTER TABLE plant ADD COLUMN image_url TEXT")
+    if not _has_column(connection, "plant", "image_status"):
+        # existing plants are picked up by the backfill-images command
+        connection.exec_driver_sql("ALTER TABLE plant ADD COLUMN image_status VARCHAR(10) NOT NULL DEFAULT 'pending'")
+
+
+DATE_BATCH_SIZE = 1000 #rows converted per transaction, keeps the write lock short
+_OLD_DATE_FORMATS = ('%d-%m-%Y', '%d/%m/%Y', '%Y-%m-%d', '%d.%m.%Y')
+_ISO_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+
+
+def _old_date(value):
+    for date_format in _OLD_DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _convert_date_planted(connection):
+    # date_planted used to be free text like "09-11-2025", it is now a Date stored as YYYY-MM-DD.
+    # rows are rewritten a batch at a time with a commit after each, so readers and
+    # writers only ever wait for one batch. text that isnt a date is moved to the notes
+    plant = Plant.__table__
+    last_id = unreadable = 0
+    while True:
+        rows = connection.execute(
+            select(plant.c.id, plant.c.date_planted.cast(db.String).label("raw"), plant.c.notes)
+            .where(plant.c.id > last_id, plant.c.date_planted.isnot(None),
+                   not_(plant.c.date_planted.cast(db.String).op("GLOB")(_ISO_GLOB)))
+            .order_by(plant.c.id).limit(DATE_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        for row in rows:
+            value = _old_date(row.raw)
+            if value is not None and format_date(value) == row.raw:
+                values = {"date_planted": value, "updated_at": plant.c.updated_at} #same updated_at, the api shows the same date
+            else: #"1/2/2024" comes out as "01-02-2024", unreadable text moves to notes, so etags have to change
+                values = {"date_planted": value, "version": plant.c.version + 1, "updated_at": utcnow()}
+            if value is None:
+                unreadable += 1
+                values["notes"] = "\n".join(part for part in (row.notes, f"date planted: {row.raw}") if part)
+            connection.execute(update(plant).where(plant.c.id == row.id).values(**values))
+        connection.commit()
+        last_id = rows[-1].id
+    if unreadable:
+        print(f"{unreadable} plants had a date_planted that isnt a date, it was moved to their notes")
+
+
+def _add_missing_indexes(connection):
+    for index in Plant.__table__.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _add_plant_search(connection):
+    if inspect(connection).has_table("plant_fts"):
+        return
+    create_plant_search(connection)
+    connection.exec_driver_sql("INSERT INTO plant_fts(plant_fts) VALUES ('rebuild')") #index existing rows
+
+
+def _add_change_log(connection):
+    # every plant without a row for its owner gets an 'upsert' so a full sync from 0 finds it.
+    # not just when plant_change is empty, a db upgraded while the triggers already ran has
+    # rows only for the plants earlier steps happened to touch
+    create_change_log(connection)
+    logged = select(PlantChange.seq).where(
+        PlantChange.plant_id == Plant.id, PlantChange.user_id.is_(Plant.user_id) #ix_plant_change_plant_id
+    ).exists()
+    connection.execute(PlantChange.__table__.insert().from_select(
+        ["plant_id", "user_id", "op"],
+        select(Plant.id, Plant.user_id, literal("upsert")).where(~logged).order_by(Plant.id),
+    ))
+
+
+STEPS = (
+    _add_plant_versioning,
+    _add_plant_owner,
+    _add_plant_image,
+    _convert_date_planted,
+    _add_missing_indexes,
+    _add_plant_search,
+    _add_change_log,
+)
+
+
+def upgrade_db():
+    # run inside an app context after db.create_all()
+    if db.engine.dialect.name != "sqlite":
+        return
+    for step in STEPS:
+        with db.engine.connect() as connection: #a step can commit part way through, see _convert_date_planted
+            step(connection)
+            connection.commit()
@@ -1,18 +1,147 @@
 
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func
+from datetime import datetime, timezone
 
 db = SQLAlchemy() #initalse SQL alchemy
 
 
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None) #naive utc, sqlite has no timezones
+
+
 class Plant(db.Model):
     id = db.Column(db.Integer, primary_key=True) #unique id
     name = db.Column(db.String(80), nullable=False)#required
     location = db.Column(db.String(120))
-    date_planted = db.Column(db.String(20))
+    date_planted = db.Column(db.Date) #stored as YYYY-MM-DD, sent to clients as DD-MM-YYYY
     height = db.Column(db.Float)
     watered = db.Column(db.Boolean, default=False)
     notes = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id')) #owner, every query is scoped to it
+    image_url = db.Column(db.Text) #filled in by the image enricher, see enrichment.py
+    image_status = db.Column(db.String(10), nullable=False, default='pending', server_default='pending')
+    version = db.Column(db.Integer, nullable=False, default=1) #bumped by sqlalchemy on every update, used for etags
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    __table_args__ = ( # indexes behind the GET /plants filters and sorts, all lead with the owner
+        db.Index('ix_plant_user_id_id', 'user_id', 'id'),
+        db.Index('ix_plant_user_updated_at', 'user_id', 'updated_at'),
+        db.Index('ix_plant_user_name', 'user_id', 'name'),
+        db.Index('ix_plant_user_name_lower', 'user_id', func.lower(name)),
+        db.Index('ix_plant_user_location', 'user_id', 'location'),
+        db.Index('ix_plant_user_height', 'user_id', 'height'),
+        db.Index('ix_plant_user_watered', 'user_id', 'watered'),
+        db.Index('ix_plant_user_date_planted', 'user_id', 'date_planted'),
+    )
+
+
+# full text search over name and notes, the triggers keep it in step with the plant table
+PLANT_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS plant_fts USING fts5(name, notes, content='plant', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS plant_fts_insert AFTER INSERT ON plant BEGIN
+        INSERT INTO plant_fts(rowid, name, notes) VALUES (new.id, new.name, new.notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS plant_fts_delete AFTER DELETE ON plant BEGIN
+        INSERT INTO plant_fts(plant_fts, rowid, name, notes) VALUES ('delete', old.id, old.name, old.notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS plant_fts_update AFTER UPDATE OF name, notes ON plant BEGIN
+        INSERT INTO plant_fts(plant_fts, rowid, name, notes) VALUES ('delete', old.id, old.name, old.notes);
+        INSERT INTO plant_fts(rowid, name, notes) VALUES (new.id, new.name, new.notes);
+    END""",
+)
+
+
+def create_plant_search(connection):
+    for ddl in PLANT_FTS_DDL:
+        connection.exec_driver_sql(ddl)
+
+
+@event.listens_for(Plant.__table__, "after_create")
+def _plant_created(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        create_plant_search(connection)
+
+
+@event.listens_for(Plant.__table__, "before_drop")
+def _plant_dropped(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("DROP TABLE IF EXISTS plant_fts")
+
+
+
+class PlantChange(db.Model): # change log behind GET /plants/changes, written by the triggers below
+    seq = db.Column(db.Integer, primary_key=True) #AUTOINCREMENT so a seq is never handed out twice
+    plant_id = db.Column(db.Integer, nullable=False, index=True) #no foreign key, tombstones outlive the plant
+    user_id = db.Column(db.Integer)
+    op = db.Column(db.String(10), nullable=False) #'create', 'upsert' (any update since) or 'delete'
+    changed_at = db.Column(db.DateTime, nullable=False, server_default=func.current_timestamp())
+
+    __table_args__ = (
+        db.Index('ix_plant_change_user_seq', 'user_id', 'seq'), #range scan for ?since=
+        {'sqlite_autoincrement': True},
+    )
+
+
+class ChangeHorizon(db.Model): # one row, changes at or below seq may have been compacted away
+    id = db.Column(db.Integer, primary_key=True)
+    seq = db.Column(db.Integer, nullable=False, default=0)
+
+
+# every write to plant, from any code path, lands in plant_change in the same
+# transaction. a plant keeps its 'create' row and its latest 'upsert' per owner, so
+# the log never grows past two rows per plant plus tombstones that havent been
+# compacted yet. handing a plant to another owner is a delete for the old one and a
+# create for the new one
+PLANT_CHANGE_DDL = {
+    "plant_change_insert": """CREATE TRIGGER plant_change_insert AFTER INSERT ON plant BEGIN
+        DELETE FROM plant_change WHERE plant_id = new.id AND user_id IS new.user_id;
+        INSERT INTO plant_change (plant_id, user_id, op) VALUES (new.id, new.user_id, 'create');
+    END""",
+    "plant_change_update": """CREATE TRIGGER plant_change_update AFTER UPDATE ON plant BEGIN
+        DELETE FROM plant_change WHERE plant_id = new.id AND (user_id IS new.user_id OR user_id IS old.user_id)
+            AND (op = 'upsert' OR old.user_id IS NOT new.user_id);
+        INSERT INTO plant_change (plant_id, user_id, op)
+            SELECT old.id, old.user_id, 'delete' WHERE old.user_id IS NOT new.user_id AND old.user_id IS NOT NULL;
+        INSERT INTO plant_change (plant_id, user_id, op)
+            VALUES (new.id, new.user_id, CASE WHEN old.user_id IS new.user_id THEN 'upsert' ELSE 'create' END);
+    END""",
+    "plant_change_delete": """CREATE TRIGGER plant_change_delete AFTER DELETE ON plant BEGIN
+        DELETE FROM plant_change WHERE plant_id = old.id AND user_id IS old.user_id;
+        INSERT INTO plant_change (plant_id, user_id, op) VALUES (old.id, old.user_id, 'delete');
+    END""",
+}
+
+
+def create_change_log(connection):
+    # run by upgrade_db (migrations.py) once the plant columns the triggers read exist,
+    # not on create_all, which makes plant_change before an old plant table is upgraded.
+    # a trigger from an older release is replaced, sqlite_master keeps the sql it was made with
+    existing = dict(connection.exec_driver_sql("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").all())
+    for name, ddl in PLANT_CHANGE_DDL.items():
+        if existing.get(name) == ddl:
+            continue
+        if name in existing:
+            connection.exec_driver_sql(f"DROP TRIGGER {name}")
+        connection.exec_driver_sql(ddl)
+
+
+class ImageCache(db.Model): # plant name -> image url, shared by all workers and kept across restarts
+    query_key = db.Column(db.String(80), primary_key=True) #normalised plant name
+    image_url = db.Column(db.Text) #None means unsplash had no result
+    fetched_at = db.Column(db.DateTime, nullable=False, default=utcnow, index=True)
+
+
+class GeocodeCache(db.Model): # city name -> coordinates from nominatim, "not a city" is stored with found=False
+    query_key = db.Column(db.String(120), primary_key=True) #normalised city name
+    found = db.Column(db.Boolean, nullable=False)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    display_name = db.Column(db.Text) #what nominatim called it
+    fetched_at = db.Column(db.DateTime, nullable=False, default=utcnow, index=True)
 
 
 class User(db.Model):
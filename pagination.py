@@ -0,0 +1,47 @@
+import base64
+import json
+from sqlalchemy import and_, or_
+
+
+class BadCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    # opaque token for "continue after this row", clients just pass it back
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise BadCursor("invalid cursor")
+    if not isinstance(values, list) or not values:
+        raise BadCursor("invalid cursor")
+    return values
+
+
+def parse_limit(value, default, maximum):
+    # page size from the query string, clamped to 1..maximum
+    if value is None or value == "":
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be a number")
+    return max(1, min(limit, maximum))
+
+
+def keyset_condition(column, value, id_column, last_id, descending=False):
+    # rows that come after (value, last_id) when ordered by column then id
+    # sqlite puts NULLs first when ascending and last when descending
+    if descending:
+        if value is None:
+            return and_(column.is_(None), id_column < last_id)
+        return or_(column < value, and_(column == value, id_column < last_id), column.is_(None))
+    if value is None:
+        return or_(and_(column.is_(None), id_column > last_id), column.isnot(None))
+    return or_(column > value, and_(column == value, id_column > last_id))
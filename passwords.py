@@ -0,0 +1,112 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+import bcrypt
+
+# bcrypt for /register and /login. hashing runs on a small process pool so a
+# login storm uses more than one core and doesnt hold the gil that cheap
+# requests need. at most HASH_MAX_PENDING hashes are queued or running per
+# worker, past that callers get HashingBusy and the app answers 503
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def load_config(config):
+    defaults = {
+        "BCRYPT_LOG_ROUNDS": int(os.getenv("BCRYPT_LOG_ROUNDS", 12)), #cost of new hashes, old ones are rehashed on login
+        "HASH_WORKERS": int(os.getenv("HASH_WORKERS", min(4, os.cpu_count() or 1))), #0 hashes in the request thread
+        "HASH_MAX_PENDING": int(os.getenv("HASH_MAX_PENDING", 16)), #hashes queued or running before 503
+        "HASH_TIMEOUT": float(os.getenv("HASH_TIMEOUT", 10)), #seconds to wait for one hash
+        "HASH_RETRY_AFTER": int(os.getenv("HASH_RETRY_AFTER", 1)), #seconds sent in Retry-After with the 503
+    }
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+
+# these two run in the pool processes, so plain functions of their arguments
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+    except ValueError:
+        return False #not a bcrypt hash or a password bcrypt cant take
+
+
+def hash_rounds(hashed):
+    # cost stored in a hash like $2b$12$..., None if it isnt one
+    try:
+        return int(hashed.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+
+    def __init__(self):
+        self._pool = None
+        self._slots = None
+        self._config = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        load_config(app.config)
+        self.configure(app.config)
+
+    def configure(self, config):
+        # (re)reads the settings, a running pool is shut down and started again on first use
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._config = {key: config[key] for key in
+                            ("BCRYPT_LOG_ROUNDS", "HASH_WORKERS", "HASH_MAX_PENDING", "HASH_TIMEOUT", "HASH_RETRY_AFTER")}
+            self._slots = threading.BoundedSemaphore(self._config["HASH_MAX_PENDING"])
+
+    @property
+    def retry_after(self):
+        return self._config["HASH_RETRY_AFTER"]
+
+    @property
+    def rounds(self):
+        return self._config["BCRYPT_LOG_ROUNDS"]
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # forkserver, not fork: by now this process runs the enricher, event hub and lookup pool
+                # threads, a forked child would copy their locks mid use. the workers only need bcrypt
+                self._pool = ProcessPoolExecutor(max_workers=self._config["HASH_WORKERS"],
+                                                 mp_context=multiprocessing.get_context("forkserver"))
+            return self._pool
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            if self._config["HASH_WORKERS"] <= 0:
+                return function(*args)
+            try:
+                return self._get_pool().submit(function, *args).result(timeout=self._config["HASH_TIMEOUT"])
+            except FutureTimeout:
+                raise HashingBusy()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+
+hasher = PasswordHasher()
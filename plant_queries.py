@@ -0,0 +1,147 @@
+import re
+from datetime import date
+from sqlalchemy import func, text
+from models import Plant
+from pagination import BadCursor, keyset_condition
+
+PLANT_FIELDS = ('id', 'name', 'location', 'date_planted', 'height', 'watered', 'notes', 'image_url')
+SORT_COLUMNS = {'id': Plant.id, 'name': Plant.name, 'location': Plant.location, 'height': Plant.height} #all indexed
+
+_TRUE = ('1', 'true', 'yes')
+_FALSE = ('0', 'false', 'no')
+
+
+def parse_fields(value):
+    # ?fields=name,location -> ('name', 'location'), everything when not given
+    if not value:
+        return PLANT_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in PLANT_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}" if unknown else "fields cant be empty")
+    return fields
+
+
+def parse_sort(value):
+    # ?sort=height or ?sort=-height, returns (column name, descending)
+    value = (value or 'id').strip()
+    descending = value.startswith('-')
+    name = value.lstrip('-')
+    if name not in SORT_COLUMNS:
+        raise ValueError(f"cant sort by {name}, use one of: {', '.join(SORT_COLUMNS)}")
+    return name, descending
+
+
+def parse_bool(value, name='watered'):
+    if value.strip().lower() in _TRUE:
+        return True
+    if value.strip().lower() in _FALSE:
+        return False
+    raise ValueError(f"{name} must be true or false")
+
+
+_DAY_FIRST = re.compile(r"(\d{2})-(\d{2})-(\d{4})") #09-11-2025, what clients have always sent
+_ISO = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+
+def parse_date(value, name='date_planted'):
+    # strict DD-MM-YYYY or YYYY-MM-DD to a date, anything else is a ValueError
+    value = value.strip() if isinstance(value, str) else ''
+    try:
+        match = _DAY_FIRST.fullmatch(value)
+        if match:
+            return date(int(match[3]), int(match[2]), int(match[1]))
+        match = _ISO.fullmatch(value)
+        if match:
+            return date(int(match[1]), int(match[2]), int(match[3]))
+    except ValueError: #right shape, not a real day
+        pass
+    raise ValueError(f"{name} must be a date like DD-MM-YYYY or YYYY-MM-DD")
+
+
+def format_date(value):
+    return value.strftime('%d-%m-%Y') if value is not None else None
+
+
+def _parse_float(args, name):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number")
+
+
+def search_expression(q):
+    # turns user input into a safe fts5 query, every word is a quoted prefix match
+    words = re.findall(r"\w+", q)
+    if not words:
+        raise ValueError("q needs at least one word")
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def plant_filters(args):
+    # where clauses for the filters in the query string, each one can use an index
+    filters = []
+
+    if args.get('location'):
+        filters.append(Plant.location == args['location'])
+
+    if args.get('watered'):
+        filters.append(Plant.watered.is_(parse_bool(args['watered'])))
+
+    if args.get('name'):
+        # range on lower(name) instead of LIKE so sqlite can use ix_plant_user_name_lower
+        prefix = args['name'].lower()
+        filters.append(func.lower(Plant.name) >= prefix)
+        filters.append(func.lower(Plant.name) < prefix + '\U0010ffff')
+
+    height_min = _parse_float(args, 'height_min')
+    height_max = _parse_float(args, 'height_max')
+    if height_min is not None:
+        filters.append(Plant.height >= height_min)
+    if height_max is not None:
+        filters.append(Plant.height <= height_max)
+
+    if args.get('planted_after'): #both ends inclusive, a range scan on ix_plant_user_date_planted
+        filters.append(Plant.date_planted >= parse_date(args['planted_after'], 'planted_after'))
+    if args.get('planted_before'):
+        filters.append(Plant.date_planted <= parse_date(args['planted_before'], 'planted_before'))
+
+    if args.get('q'):
+        # checked per plant of the user (plant_fts looked up by rowid) rather than every
+        # users matches collected first, so a search costs the size of one garden
+        filters.append(text(
+            "EXISTS (SELECT 1 FROM plant_fts WHERE plant_fts.rowid = plant.id AND plant_fts MATCH :q)"
+        ).bindparams(q=search_expression(args['q'])))
+
+    return filters
+
+
+def page_after(sort, descending, cursor):
+    # where clause that continues a listing after the row the cursor points at
+    column = SORT_COLUMNS[sort]
+    if sort == 'id':
+        if len(cursor) != 1 or not isinstance(cursor[0], int):
+            raise BadCursor("invalid cursor")
+        return Plant.id < cursor[0] if descending else Plant.id > cursor[0]
+
+    if len(cursor) != 2 or not isinstance(cursor[1], int) or not isinstance(cursor[0], (str, int, float, type(None))):
+        raise BadCursor("invalid cursor")
+    return keyset_condition(column, cursor[0], Plant.id, cursor[1], descending)
+
+
+def order_by(sort, descending):
+    column = SORT_COLUMNS[sort]
+    if sort == 'id':
+        return [column.desc() if descending else column]
+    if descending:
+        return [column.desc(), Plant.id.desc()]
+    return [column, Plant.id]
+
+
+def cursor_for(sort, row):
+    if sort == 'id':
+        return [row.id]
+    return [getattr(row, sort), row.id]
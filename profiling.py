@@ -0,0 +1,187 @@
+import cProfile
+import json
+import os
+import pstats
+import random
+import time
+import uuid
+from contextvars import ContextVar
+from flask import current_app, g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from models import db
+import http_client
+
+# opt in profiling of single requests. a request is profiled when an admin
+# sends "X-Profile: 1" or when it is picked by PROFILE_SAMPLE_RATE. it runs
+# under cProfile, every sql statement is kept with its timing and query plan,
+# every outbound call is kept, and one json report is written to PROFILE_DIR.
+# requests that arent picked only pay for a header lookup and a random()
+
+PROFILE_HEADER = "X-Profile"
+TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", 40)) #rows of cProfile output kept in a report
+
+# the report being filled for this request, a context var so the image pool
+# and weather threads started by the request add to it too
+_report = ContextVar("profile_report", default=None)
+
+
+def load_config(config):
+    defaults = {
+        "PROFILE_DIR": os.getenv("PROFILE_DIR"), #unset turns profiling off
+        "PROFILE_ADMINS": {int(user_id) for user_id in os.getenv("PROFILE_ADMINS", "").split(",") if user_id.strip()},
+        "PROFILE_SAMPLE_RATE": float(os.getenv("PROFILE_SAMPLE_RATE", 0)), #0.01 profiles about 1 request in 100
+    }
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+
+def _admin_asked(config):
+    if request.headers.get(PROFILE_HEADER) != "1" or not config["PROFILE_ADMINS"]:
+        return False
+    try:
+        verify_jwt_in_request(optional=True)
+        return int(get_jwt_identity()) in config["PROFILE_ADMINS"]
+    except Exception:
+        return False #bad or missing token, the view itself will answer 401
+
+
+def _start():
+    config = current_app.config
+    if not config["PROFILE_DIR"]:
+        return
+    rate = config["PROFILE_SAMPLE_RATE"]
+    if rate > 0 and random.random() < rate:
+        trigger = "sample"
+    elif _admin_asked(config):
+        trigger = "header"
+    else:
+        return
+    g.profile = {
+        "trigger": trigger,
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "started": time.time(),
+        "sql": [],
+        "upstream": [],
+        "_clock": time.perf_counter(),
+        "_profiler": cProfile.Profile(),
+    }
+    g.profile_token = _report.set(g.profile)
+    g.profile["_profiler"].enable()
+
+
+def _finish(response):
+    report = g.pop("profile", None)
+    if report is None:
+        return response
+    profiler = report.pop("_profiler")
+    profiler.disable()
+    _report.reset(g.pop("profile_token"))
+    report["duration_ms"] = round((time.perf_counter() - report.pop("_clock")) * 1000, 3)
+    report["endpoint"] = request.endpoint
+    report["status"] = response.status_code
+    report["streamed"] = response.is_streamed #a streamed body is sent after the report is written
+    _explain(report["sql"])
+    report["sql_total_ms"] = round(sum(statement["ms"] for statement in report["sql"]), 3)
+    report["sql_repeated"] = _repeated(report["sql"])
+    report["functions"] = _top_functions(profiler)
+
+    os.makedirs(current_app.config["PROFILE_DIR"], exist_ok=True)
+    name = f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.json"
+    path = os.path.join(current_app.config["PROFILE_DIR"], name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(report, f, indent=1, default=str)
+    os.replace(path + ".tmp", path)
+    response.headers["X-Profile-Report"] = name
+    return response
+
+
+def _explain(statements):
+    # query plans are only asked for once the request is done so they dont count in its timings.
+    # the raw dbapi connection skips the engine events, so these dont end up in the report
+    all_parameters = [statement.pop("_parameters") for statement in statements]
+    if db.engine.dialect.name != "sqlite":
+        return
+    plans = {}
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for statement, parameters in zip(statements, all_parameters):
+            if statement["executemany"] or not statement["statement"].lstrip().upper().startswith(("SELECT", "WITH")):
+                continue
+            key = (statement["statement"], repr(parameters))
+            if key not in plans:
+                try:
+                    cursor.execute("EXPLAIN QUERY PLAN " + statement["statement"], parameters)
+                    plans[key] = [row[-1] for row in cursor.fetchall()]
+                except Exception as e:
+                    plans[key] = [f"explain failed: {e}"]
+            statement["plan"] = plans[key]
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def _repeated(statements):
+    # same sql run more than once in a request, the usual sign of an n+1
+    counts = {}
+    for statement in statements:
+        counts[statement["statement"]] = counts.get(statement["statement"], 0) + 1
+    return [{"statement": sql, "count": count} for sql, count in counts.items() if count > 1]
+
+
+def _top_functions(profiler):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {"function": f"{filename}:{line}({name})", "calls": calls, "primitive_calls": primitive,
+         "own_ms": round(own * 1000, 3), "cumulative_ms": round(cumulative * 1000, 3)}
+        for (filename, line, name), (primitive, calls, own, cumulative, _) in rows
+    ]
+
+
+def _teardown(exc):
+    # after_request didnt get to it (another hook failed), dont leave the profiler running
+    report = g.pop("profile", None)
+    if report is not None:
+        report["_profiler"].disable()
+        _report.reset(g.pop("profile_token"))
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    if _report.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    report = _report.get()
+    if report is None or not conn.info.get("profile_started"):
+        return
+    elapsed = time.perf_counter() - conn.info["profile_started"].pop()
+    report["sql"].append({"statement": statement, "ms": round(elapsed * 1000, 3), "executemany": executemany,
+                          "_parameters": parameters}) #parameters are only used for the plan, not written out
+
+
+@event.listens_for(Engine, "handle_error")
+def _sql_failed(context):
+    if context.connection is not None and context.connection.info.get("profile_started"):
+        context.connection.info["profile_started"].pop()
+
+
+def _upstream_call(url, seconds, status, error):
+    report = _report.get()
+    if report is not None:
+        report["upstream"].append({"url": url.split("?")[0], "ms": round(seconds * 1000, 3), "status": status,
+                                   "error": repr(error) if error is not None else None})
+
+
+def init_profiling(app):
+    load_config(app.config)
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_teardown)
+    http_client.add_listener(_upstream_call)
@@ -0,0 +1,192 @@
+import math
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from flask import current_app, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+import http_client
+from metrics import registry
+
+# in memory token buckets, per process. every request takes a token from its
+# clients ip bucket and from the bucket for (user or ip, endpoint), an empty
+# bucket is answered with 429 and Retry-After before the view runs. outbound
+# calls take a token from the bucket of their upstream host, so one busy
+# client cant spend the unsplash / openweathermap / nominatim quota for everyone.
+# a limit is "rate:burst", tokens added a second and the most a bucket holds
+
+
+def parse_rate(value):
+    # "10:20" -> (10.0, 20.0), "" / "0" / "off" -> None for no limit
+    value = (value or "").strip()
+    if value in ("", "0", "off"):
+        return None
+    rate, _, burst = value.partition(":")
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate, 1.0)
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"rate limit {value!r} should be rate:burst, like 10:20")
+    return rate, burst
+
+
+def parse_rates(value):
+    # "weather=1:10,plantresource=off" -> {"weather": (1.0, 10.0), "plantresource": None}
+    rates = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            name, _, rate = item.partition("=")
+            rates[name.strip()] = parse_rate(rate)
+    return rates
+
+
+# endpoints that call upstreams on a cache miss get less than the default
+ENDPOINT_LIMITS = {
+    "weather": (1, 10),
+    "weather_many": (0.2, 3),
+    "login": (0.5, 10), #the hashing pool has its own limit, see passwords.py
+    "register": (0.1, 5),
+    "metrics": None,
+}
+
+# published quotas: unsplash production keys get 5000 an hour, openweathermaps
+# free plan 60 a minute, nominatims usage policy asks for 1 a second at most
+UPSTREAM_LIMITS = {
+    "api.unsplash.com": (5000 / 3600, 50),
+    "api.openweathermap.org": (1, 60),
+    "nominatim.openstreetmap.org": (1, 1),
+}
+UPSTREAM_LIMITS.update(parse_rates(os.getenv("UPSTREAM_RATE_LIMITS"))) #"host=rate:burst,..."
+UPSTREAM_MAX_WAIT = float(os.getenv("UPSTREAM_RATE_LIMIT_WAIT", 1)) #seconds a call waits for a token before failing
+
+
+def load_config(config):
+    defaults = {
+        "RATE_LIMIT_ENABLED": os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "RATE_LIMIT_DEFAULT": parse_rate(os.getenv("RATE_LIMIT_DEFAULT", "10:30")), #per user (or ip) per endpoint
+        "RATE_LIMIT_IP": parse_rate(os.getenv("RATE_LIMIT_IP", "50:100")), #per ip over every endpoint
+        "RATE_LIMITS": dict(ENDPOINT_LIMITS, **parse_rates(os.getenv("RATE_LIMITS"))), #"endpoint=rate:burst,..."
+        "RATE_LIMIT_PROXIES": int(os.getenv("RATE_LIMIT_PROXIES", 0)), #proxies in front that set X-Forwarded-For
+    }
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+
+class Limiter:
+    # token buckets keyed by anything hashable, a bucket is [tokens, updated, rate, burst]
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, max_wait=0.0):
+        # 0 when a token was there, else seconds until there is one. a wait up to max_wait
+        # reserves the token (the bucket goes negative) and the caller sleeps for it
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._sweep(now)
+                bucket = self._buckets[key] = [burst, now, rate, burst]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            wait = (1 - tokens) / rate if tokens < 1 else 0.0
+            if wait <= max_wait:
+                tokens -= 1
+            bucket[0], bucket[1] = tokens, now
+            return wait
+
+    def _sweep(self, now):
+        # a full bucket is the same as no bucket, drop those. if every one is in use
+        # (someone cycling through addresses) start over rather than grow without end
+        for key, (tokens, updated, rate, burst) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+        if len(self._buckets) >= self.max_keys:
+            self._buckets.clear()
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+clients = Limiter()
+upstreams = Limiter()
+
+registry.declare("rate_limited_total", "counter", "Requests answered 429 by the rate limiter.")
+registry.declare("upstream_throttled_total", "counter", "Calls to external apis held back or refused by their rate limit.")
+
+
+class UpstreamThrottled(requests.RequestException):
+    # a RequestException so callers treat it like the upstream being down
+
+    def __init__(self, host, retry_after):
+        super().__init__(f"{host} rate limit reached, try again in {retry_after:.1f}s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+def _upstream_gate(url):
+    host = urlsplit(url).netloc
+    limit = UPSTREAM_LIMITS.get(host)
+    if limit is None:
+        return
+    wait = upstreams.take(host, *limit, max_wait=UPSTREAM_MAX_WAIT)
+    if wait:
+        registry.inc("upstream_throttled_total", {"host": host, "outcome": "waited" if wait <= UPSTREAM_MAX_WAIT else "refused"})
+        if wait > UPSTREAM_MAX_WAIT:
+            raise UpstreamThrottled(host, wait)
+        time.sleep(wait)
+
+
+def client_ip():
+    proxies = current_app.config["RATE_LIMIT_PROXIES"]
+    if proxies:
+        forwarded = [part.strip() for part in request.headers.get("X-Forwarded-For", "").split(",") if part.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies] #the address the nearest trusted proxy saw
+    return request.remote_addr
+
+
+def _identity():
+    # the users id when the request carries a valid token, else None and the ip is used
+    if "Authorization" not in request.headers:
+        return None
+    try:
+        verify_jwt_in_request(optional=True)
+        return get_jwt_identity()
+    except Exception:
+        return None #bad or expired token, the view itself will answer 401
+
+
+def _throttled(scope, wait):
+    registry.inc("rate_limited_total", {"endpoint": request.endpoint or "unknown", "scope": scope})
+    return {'message': 'too many requests, please slow down'}, 429, {'Retry-After': str(math.ceil(wait))}
+
+
+def _before_request():
+    config = current_app.config
+    if not config["RATE_LIMIT_ENABLED"] or request.method == "OPTIONS":
+        return None
+    ip = client_ip()
+    ip_limit = config["RATE_LIMIT_IP"]
+    if ip_limit is not None:
+        wait = clients.take(("ip", ip), *ip_limit)
+        if wait:
+            return _throttled("ip", wait)
+    endpoint = request.endpoint
+    limit = config["RATE_LIMITS"].get(endpoint, config["RATE_LIMIT_DEFAULT"])
+    if limit is not None:
+        user_id = _identity()
+        key = ("user", user_id, endpoint) if user_id is not None else ("ip", ip, endpoint)
+        wait = clients.take(key, *limit)
+        if wait:
+            return _throttled("user" if user_id is not None else "ip", wait)
+    return None
+
+
+def init_rate_limits(app):
+    load_config(app.config)
+    app.before_request(_before_request)
+    http_client.add_gate(_upstream_gate)
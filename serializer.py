@@ -0,0 +1,44 @@
+import orjson
+from flask import Response
+from models import Plant
+from plant_queries import format_date
+
+# one way of turning plant rows into json. handlers select plain columns (no
+# orm objects) and the encoded bytes go straight into the response, skipping
+# flask_restfuls encoder
+
+dumps = orjson.dumps
+
+
+def plant_columns(fields, extra=()):
+    # columns to select for these fields, plus any the caller needs itself (cursor, etag)
+    return [getattr(Plant, name) for name in dict.fromkeys(list(fields) + list(extra))]
+
+
+_FORMATTERS = {'date_planted': format_date} #columns whose values json cant take as they are
+
+
+def plant_dict(row, fields):
+    plant = {field: getattr(row, field) for field in fields}
+    for field, formatter in _FORMATTERS.items():
+        if field in plant:
+            plant[field] = formatter(plant[field])
+    return plant
+
+
+def encode_plant(row, fields):
+    return dumps(plant_dict(row, fields))
+
+
+def encode_plant_page(rows, fields, next_cursor):
+    # body of GET /plants one plant at a time, never builds the whole list of dicts
+    yield b'{"plants":['
+    for index, row in enumerate(rows):
+        if index:
+            yield b','
+        yield encode_plant(row, fields)
+    yield b'],"next_cursor":' + dumps(next_cursor) + b'}'
+
+
+def json_response(body, status=200, headers=None):
+    return Response(body, status, headers, mimetype='application/json')
@@ -0,0 +1,118 @@
+import os
+from flask import has_app_context
+from flask.globals import app_ctx
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from models import db
+
+# sqlite tuning for several gunicorn workers sharing plants.db: WAL so readers
+# and the writer dont block each other, a busy timeout instead of instant
+# "database is locked", and optionally a second engine that only reads
+
+
+def load_config(config):
+    # storage settings from the environment, values already in config win
+    defaults = {
+        "SQLITE_JOURNAL_MODE": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+        "SQLITE_SYNCHRONOUS": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"), #safe with WAL, only the last commits can be lost on power cut
+        "SQLITE_MMAP_SIZE": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)), #bytes read through mmap
+        "SQLITE_CACHE_SIZE": int(os.getenv("SQLITE_CACHE_SIZE", -64000)), #negative is KiB, so about 64MB per connection
+        "SQLITE_BUSY_TIMEOUT": int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)), #ms to wait for a lock
+        "SQLITE_READ_ENGINE": os.getenv("SQLITE_READ_ENGINE", "false").lower() in ("1", "true", "yes"),
+        "DB_POOL_SIZE": int(os.getenv("DB_POOL_SIZE", 5)),
+        "DB_MAX_OVERFLOW": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "DB_POOL_TIMEOUT": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+        "DB_READ_POOL_SIZE": int(os.getenv("DB_READ_POOL_SIZE", 10)),
+    }
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+
+def sqlite_pragmas(config):
+    return (
+        f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+        f"PRAGMA cache_size={int(config['SQLITE_CACHE_SIZE'])}",
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT'])}",
+    )
+
+
+def engine_options(config, uri, pool_size=None):
+    # keyword arguments for create_engine / SQLALCHEMY_ENGINE_OPTIONS
+    if not uri.startswith("sqlite") or ":memory:" in uri or uri in ("sqlite://", "sqlite:///"):
+        return {} #in memory dbs keep sqlalchemys single connection pool
+    return {
+        "pool_size": pool_size or config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_pre_ping": False, #a local file doesnt drop connections
+        "connect_args": {"timeout": config["SQLITE_BUSY_TIMEOUT"] / 1000, "check_same_thread": False},
+    }
+
+
+def install_pragmas(engine, pragmas, read_only=False):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+def configure_storage(app):
+    # call before db.init_app so the pool settings are used
+    load_config(app.config)
+    options = engine_options(app.config, app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {**options, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})}
+
+
+_read_sessions = None
+_read_engine = None
+
+
+def _app_ctx_id():
+    return id(app_ctx._get_current_object())
+
+
+def init_storage(app):
+    # call in an app context after db.init_app
+    if db.engine.dialect.name != "sqlite":
+        return
+    install_pragmas(db.engine, sqlite_pragmas(app.config))
+    db.engine.dispose() #connections opened before the listener existed
+    if app.config["SQLITE_READ_ENGINE"]:
+        open_read_engine(app)
+
+    @app.teardown_appcontext
+    def remove_read_session(exc):
+        if _read_sessions is not None:
+            _read_sessions.remove()
+
+
+def open_read_engine(app):
+    # separate pool of query_only connections so reads never wait behind writers for a connection
+    global _read_sessions, _read_engine
+    url = db.engine.url
+    if not url.database or url.database == ":memory:":
+        return
+    _read_engine = create_engine(url, **engine_options(app.config, str(url), app.config["DB_READ_POOL_SIZE"]))
+    install_pragmas(_read_engine, sqlite_pragmas(app.config), read_only=True)
+    _read_sessions = scoped_session(sessionmaker(bind=_read_engine), scopefunc=_app_ctx_id)
+
+
+def close_read_engine():
+    global _read_sessions, _read_engine
+    if _read_engine is not None:
+        _read_sessions.remove()
+        _read_engine.dispose()
+    _read_sessions = _read_engine = None
+
+
+def read_session():
+    # session for GET handlers, the read only engine when it is switched on
+    if _read_sessions is not None and has_app_context():
+        return _read_sessions
+    return db.session
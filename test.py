@@ -1,7 +1,7 @@
-from geopy.geocoders import Nominatim
+from external_apis import make_geolocator
 
 def city_exists(city_name):
-    geolocator = Nominatim(user_agent="city_checker", timeout=10)  # 10 seconds timeout
+    geolocator = make_geolocator("city_checker")  # shares the pooled http client and its timeouts
     try:
         location = geolocator.geocode(city_name)
         if location and "Ireland" in location.address:
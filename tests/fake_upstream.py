@@ -0,0 +1,80 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class FakeUpstream:
+    """local stand in for unsplash, nominatim and openweathermap"""
+
+    def __init__(self):
+        self.cities = {"dublin": (53.3498, -6.2603, "Dublin, Leinster, Ireland")}
+        self.images = {"rose": "http://img/rose.jpg"}
+        self.temperature = 16
+        self.temperatures = {} #city -> temperature, overrides the one above
+        self.descriptions = {} #city -> description, "sunny" otherwise
+        self.delay = 0
+        self.calls = []
+        self.connections = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, path):
+        return sum(1 for call in self.calls if call == path)
+
+    def respond(self, path, query):
+        if path == "/search/photos":
+            image = self.images.get(query.get("query", [""])[0].lower())
+            return 200, {"results": [{"urls": {"regular": image}}] if image else []}
+        if path == "/search":
+            city = self.cities.get(query.get("q", [""])[0].lower())
+            if not city:
+                return 200, []
+            lat, lon, name = city
+            return 200, [{"lat": str(lat), "lon": str(lon), "display_name": name}]
+        if path == "/data/2.5/weather":
+            lat, lon = float(query["lat"][0]), float(query["lon"][0])
+            for city, (city_lat, city_lon, name) in self.cities.items():
+                if (round(city_lat, 2), round(city_lon, 2)) == (round(lat, 2), round(lon, 2)):
+                    return 200, {"name": name.split(",")[0], "sys": {"country": "IE"},
+                                 "main": {"temp": self.temperatures.get(city, self.temperature)},
+                                 "weather": [{"description": self.descriptions.get(city, "sunny")}]}
+            return 404, {"cod": "404", "message": "city not found"}
+        return 404, {}
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive like the real apis
+
+            def setup(self):
+                super().setup()
+                upstream.connections += 1
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                upstream.calls.append(url.path)
+                if upstream.delay:
+                    threading.Event().wait(upstream.delay)
+                status, body = upstream.respond(url.path, parse_qs(url.query))
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,7 +1,39 @@
 
 import pytest 
-from app import app, db, bcrypt
-from models import Plant, User
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import date
+import gzip
+import zlib
+import requests
+
+# the engine is made when app is imported, so the test db has to be picked before that
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='plant-tests-'), 'plants.db')}")
+
+import external_apis
+import http_client
+import test
+import storage
+import metrics
+import identity
+import sqlalchemy
+import serializer
+import migrations
+import changes
+import enrichment
+import ratelimit
+from events import hub
+from datetime import timedelta
+from plant_queries import plant_filters
+import bcrypt as bcrypt_lib
+from passwords import hasher, hash_rounds, _hash
+from fake_upstream import FakeUpstream
+from app import app, db
+from models import Plant, User, ImageCache, GeocodeCache, PlantChange
 from flask_jwt_extended import create_access_token
 
 
@@ -9,27 +41,49 @@ from flask_jwt_extended import create_access_token
 
 
 @pytest.fixture
-def client():
+def upstream():
+    """local fake of the external apis, reached through the shared http client"""
+    fake = FakeUpstream().start()
+    previous = (external_apis.UNSPLASH_URL, external_apis.OPENWEATHER_URL, external_apis.NOMINATIM_URL)
+    external_apis.use_upstreams(fake.url, fake.url, fake.url)
+    yield fake
+    external_apis.use_upstreams(*previous)
+    fake.stop()
+
+
+@pytest.fixture
+def client(upstream):
     """sets up pytest DB"""
     app.config["TESTING"] = True
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:" # DB in memory
 
     app.config["SECRET_KEY"]="test-secret"
     app.config["JWT_SECRET_KEY"]="test-jwt-secret"
+    app.config["IMAGE_ENRICH_INLINE"] = True # image lookups happen during post/put, no background thread
+    app.config["STREAM_POLL_INTERVAL"] = 3600 # tests call hub.poll themselves
+    app.config["STREAM_HEARTBEAT"] = 0.05
+    app.config["RATE_LIMIT_ENABLED"] = False # tests send requests faster than any client should, the rate limit tests turn it on
+
+    external_apis.image_cache.clear() # dont leak cached lookups between tests
+    external_apis.geocode_cache.clear()
+    external_apis.weather_cache.clear()
+    identity.user_cache.clear() # ids are reused once the tables are recreated
+    ratelimit.clients.clear() # every test starts with full buckets
+    ratelimit.upstreams.clear()
 
     with app.test_client() as client: # create a temp client for requests
         with app.app_context(): 
             db.create_all() # create DB with all tables
+            migrations.upgrade_db() # and the change log triggers, as on startup
             yield client # run using this client
             db.drop_all()
 
 
 
-def auth(client):
+def auth(client, username="testuser"):
     with app.app_context():
-        hashed_pw=bcrypt.generate_password_hash("Password123").decode("utf-8") #generate hashed pass
-        user = User(username="testuser", email="test@test.com", password=hashed_pw) #user obejct 
+        hashed_pw=_hash("Password123", hasher.rounds) #generate hashed pass, straight past the pool so a full one doesnt matter
+        user = User(username=username, email=f"{username}@test.com", password=hashed_pw) #user obejct 
         db.session.add(user) #add user to database
         db.session.commit()
 
@@ -484,6 +538,1188 @@ def test_login_with_incorrect_password(client):
 
 
 
+def test_plant_image_is_cached(client, mocker):
+    """second lookup for the same name doesnt call unsplash"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", return_value="http://img/rose.jpg")
+    assert external_apis.get_plant_image("Rose") == "http://img/rose.jpg"
+    assert external_apis.get_plant_image(" rose ") == "http://img/rose.jpg"
+    assert fetch.call_count == 1
+
+
+def test_plant_image_no_result_is_cached(client, mocker):
+    """unsplash having no image is remembered as well"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    assert external_apis.get_plant_image("fancy flower") is None
+    assert external_apis.get_plant_image("fancy flower") is None
+    assert fetch.call_count == 1
+
+
+def test_plant_image_cache_survives_restart(client, mocker):
+    """entries are read back from the image_cache table when memory is empty"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", return_value="http://img/lily.jpg")
+    external_apis.get_plant_image("Lily")
+    external_apis.image_cache.clear() # what a fresh worker would see
+    assert db.session.get(ImageCache, "lily").image_url == "http://img/lily.jpg"
+    assert external_apis.get_plant_image("Lily") == "http://img/lily.jpg"
+    assert fetch.call_count == 1
+
+
+def test_plant_image_upstream_error_not_cached(client, mocker):
+    """a failed unsplash call is retried on the next lookup"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", side_effect=requests.ConnectionError("down"))
+    assert external_apis.get_plant_image("Tulip") is None
+    assert external_apis.get_plant_image("Tulip") is None
+    assert fetch.call_count == 2
+
+
+
+def test_list_plants_looks_up_each_name_once(client, mocker):
+    """plants sharing a name only cause one image lookup"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", return_value="http://img/rose.jpg")
+    headers = auth(client)
+    for location in ("Dublin", "Cork", "Galway"):
+        client.post("/plants", json={"name": "Rose", "location": location, "date_planted": "09-11-2025"}, headers=headers)
+    client.post("/plants", json={"name": "Lily", "location": "Cork", "date_planted": "09-11-2025"}, headers=headers)
+
+    response = client.get("/plants", headers=headers)
+    assert response.status_code == 200
+    assert [plant["image_url"] for plant in response.get_json()["plants"]] == ["http://img/rose.jpg"] * 4
+    assert fetch.call_count == 2
+
+
+def test_resolve_images_deadline(client, mocker):
+    """lookups still running at the deadline come back as None"""
+    mocker.patch("external_apis.fetch_plant_image", side_effect=lambda name: time.sleep(0.5) or "http://img/slow.jpg")
+    images = external_apis.resolve_plant_images(["Oak", "Oak"], deadline=0.05)
+    assert images == {"Oak": None}
+
+
+
+def add_plants(client, headers, count):
+    for i in range(count):
+        client.post("/plants", json={"name": f"Plant {i}", "location": "Dublin", "date_planted": "09-11-2025"}, headers=headers)
+
+
+def test_get_plants_paginated(client, mocker):
+    """walks the list with limit and the next cursor"""
+    mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    headers = auth(client)
+    add_plants(client, headers, 5)
+
+    seen = []
+    cursor = None
+    while True:
+        query = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        data = client.get("/plants", query_string=query, headers=headers).get_json()
+        seen += [plant["id"] for plant in data["plants"]]
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == [1, 2, 3, 4, 5]
+
+
+def test_get_plants_bad_cursor(client):
+    """garbage cursor is rejected"""
+    headers = auth(client)
+    response = client.get("/plants?cursor=notacursor", headers=headers)
+    assert response.status_code == 400
+
+
+def test_get_plants_fields(client, mocker):
+    """only the requested fields are returned and no image lookup happens"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    headers = auth(client)
+    add_plants(client, headers, 2)
+    fetch.reset_mock() #the posts looked them up
+    data = client.get("/plants?fields=name,location", headers=headers).get_json()
+    assert data["plants"][0] == {"name": "Plant 0", "location": "Dublin"}
+    assert fetch.call_count == 0
+
+
+def test_get_plants_unknown_field(client):
+    """unknown field names are a 400"""
+    headers = auth(client)
+    response = client.get("/plants?fields=name,password", headers=headers)
+    assert response.status_code == 400
+
+
+
+def add_garden(client, headers):
+    for name, location, height, watered, notes in (
+        ("Rose", "Dublin", 10.5, True, "red and thorny"),
+        ("Rosemary", "Cork", 30, False, "herb for the kitchen"),
+        ("Lily", "Dublin", 50, False, "white flowers"),
+        ("Oak", "Galway", None, True, "planted by the wall"),
+    ):
+        client.post("/plants", json={"name": name, "location": location, "date_planted": "09-11-2025",
+                                     "height": height, "watered": watered, "notes": notes}, headers=headers)
+
+
+def plant_names(client, headers, query):
+    response = client.get("/plants", query_string=dict(query, fields="name"), headers=headers)
+    assert response.status_code == 200
+    return [plant["name"] for plant in response.get_json()["plants"]]
+
+
+def test_filter_plants(client):
+    """location, watered, name prefix and height range filters"""
+    headers = auth(client)
+    add_garden(client, headers)
+    assert plant_names(client, headers, {"location": "Dublin"}) == ["Rose", "Lily"]
+    assert plant_names(client, headers, {"watered": "true"}) == ["Rose", "Oak"]
+    assert plant_names(client, headers, {"name": "ros"}) == ["Rose", "Rosemary"]
+    assert plant_names(client, headers, {"height_min": 20, "height_max": 40}) == ["Rosemary"]
+
+
+def test_filter_plants_bad_value(client):
+    """non numeric height filter is a 400"""
+    headers = auth(client)
+    response = client.get("/plants?height_min=tall", headers=headers)
+    assert response.status_code == 400
+
+
+def test_sort_plants_paginated(client):
+    """sorting by a nullable column keeps working across pages"""
+    headers = auth(client)
+    add_garden(client, headers)
+    for sort, expected in (("height", ["Oak", "Rose", "Rosemary", "Lily"]),
+                           ("-height", ["Lily", "Rosemary", "Rose", "Oak"]),
+                           ("name", ["Lily", "Oak", "Rose", "Rosemary"])):
+        names = []
+        query = {"sort": sort, "limit": 1, "fields": "name"}
+        while True:
+            data = client.get("/plants", query_string=query, headers=headers).get_json()
+            names += [plant["name"] for plant in data["plants"]]
+            if data["next_cursor"] is None:
+                break
+            query["cursor"] = data["next_cursor"]
+        assert names == expected
+
+
+def test_search_plants(client):
+    """q searches name and notes and follows updates and deletes"""
+    headers = auth(client)
+    add_garden(client, headers)
+    assert plant_names(client, headers, {"q": "thorn"}) == ["Rose"]
+    assert plant_names(client, headers, {"q": "kitchen herb"}) == ["Rosemary"]
+
+    client.put("/plants/3", json={"name": "Tiger Lily"}, headers=headers)
+    assert plant_names(client, headers, {"q": "tiger"}) == ["Tiger Lily"]
+
+    client.delete("/plants/1", headers=headers)
+    assert plant_names(client, headers, {"q": "thorny"}) == []
+
+
+
+def test_search_scoped_to_user(client):
+    """q only looks at the callers plants, one fts lookup by rowid each"""
+    headers = auth(client)
+    other = auth(client, "otheruser")
+    for owner in (headers, other):
+        client.post("/plants", json={"name": "Rose", "location": "Cork", "date_planted": "01-01-2025"}, headers=owner)
+    assert plant_names(client, headers, {"q": "rose"}) == ["Rose"]
+    filters = [Plant.user_id == 1] + plant_filters({"q": "rose"})
+    query = sqlalchemy.select(Plant.id).where(*filters).compile(db.engine, compile_kwargs={"literal_binds": True})
+    plan = " ".join(row[-1] for row in db.session.execute(sqlalchemy.text(f"EXPLAIN QUERY PLAN {query}")).all())
+    assert "SEARCH plant USING COVERING INDEX ix_plant_user_" in plan and "(user_id=?)" in plan
+    assert "VIRTUAL TABLE INDEX 0:=" in plan #rowid equality, not a scan of every match
+
+
+
+def test_bulk_import_ndjson(client):
+    """valid lines are inserted and bad ones reported by line number"""
+    headers = auth(client)
+    body = "\n".join([
+        '{"name": "Rose", "location": "Dublin", "date_planted": "09-11-2025", "height": 10}',
+        '{"name": "Lily", "location": "Cork"}',
+        'not json',
+        '',
+        '{"name": "Oak", "location": "Galway", "date_planted": "01-01-2020", "height": -1}',
+        '{"name": "Fern", "location": "Cork", "date_planted": "01-01-2020", "watered": true}',
+    ])
+    response = client.post("/plants/bulk", data=body, content_type="application/x-ndjson", headers=headers)
+    assert response.status_code == 201
+    report = response.get_json()
+    assert report["inserted"] == 2
+    assert report["failed"] == 3
+    assert [error["line"] for error in report["errors"]] == [2, 3, 5]
+    assert plant_names(client, headers, {}) == ["Rose", "Fern"]
+
+
+def test_bulk_import_csv_in_batches(client):
+    """csv rows go in across several batches"""
+    headers = auth(client)
+    app.config["BULK_BATCH_SIZE"] = 2
+    try:
+        rows = ["name,location,date_planted,height,watered"]
+        rows += [f"Plant {i},Dublin,09-11-2025,{i},{'true' if i % 2 else 'false'}" for i in range(5)]
+        rows.append("Bad,Dublin,09-11-2025,tall,true")
+        response = client.post("/plants/bulk", data="\n".join(rows), content_type="text/csv", headers=headers)
+    finally:
+        app.config["BULK_BATCH_SIZE"] = 1000
+    report = response.get_json()
+    assert report["inserted"] == 5
+    assert report["errors"] == [{"line": 7, "message": "height must be a number"}]
+    assert plant_names(client, headers, {"watered": "true"}) == ["Plant 1", "Plant 3"]
+
+
+def test_bulk_import_looks_up_images(client, mocker):
+    """imported plants get their images, one lookup per name across batches"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", side_effect=lambda name: f"http://img/{name}.jpg")
+    headers = auth(client)
+    app.config["BULK_BATCH_SIZE"] = 2
+    try:
+        body = "\n".join(f'{{"name": "{name}", "location": "Cork", "date_planted": "01-01-2025"}}' for name in ("Rose", "Rose", "Fern", "Rose"))
+        assert client.post("/plants/bulk", data=body, content_type="application/x-ndjson", headers=headers).status_code == 201
+    finally:
+        app.config["BULK_BATCH_SIZE"] = 1000
+    assert sorted(call.args[0] for call in fetch.call_args_list) == ["Fern", "Rose"] #the second batch hits the image cache
+    db.session.expire_all()
+    plants = db.session.query(Plant).order_by(Plant.id).all()
+    assert [(plant.image_status, plant.image_url) for plant in plants] == [
+        ("done", "http://img/Rose.jpg"), ("done", "http://img/Rose.jpg"),
+        ("done", "http://img/Fern.jpg"), ("done", "http://img/Rose.jpg")]
+
+
+def test_bulk_import_wrong_content_type(client):
+    """only ndjson and csv bodies are accepted"""
+    headers = auth(client)
+    response = client.post("/plants/bulk", json=[{"name": "Rose"}], headers=headers)
+    assert response.status_code == 415
+
+
+
+def test_export_ndjson(client, mocker):
+    """every plant comes out as one json line without image lookups"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    headers = auth(client)
+    add_garden(client, headers)
+    fetch.reset_mock()
+    app.config["EXPORT_CHUNK_SIZE"] = 3
+    try:
+        response = client.get("/plants/export", headers=headers)
+        lines = response.get_data(as_text=True).splitlines()
+    finally:
+        app.config["EXPORT_CHUNK_SIZE"] = 1000
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert [json.loads(line)["name"] for line in lines] == ["Rose", "Rosemary", "Lily", "Oak"]
+    assert "image_url" not in json.loads(lines[0])
+    assert fetch.call_count == 0
+
+
+def test_export_csv_with_filter_and_images(client, mocker):
+    """csv export with a filter and image enrichment switched on"""
+    mocker.patch("external_apis.fetch_plant_image", return_value="http://img/plant.jpg")
+    headers = auth(client)
+    add_garden(client, headers)
+    response = client.get("/plants/export?format=csv&location=Dublin&images=true", headers=headers)
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [row["name"] for row in rows] == ["Rose", "Lily"]
+    assert rows[0]["image_url"] == "http://img/plant.jpg"
+
+
+def test_export_bad_format(client):
+    """unknown export format is a 400"""
+    headers = auth(client)
+    response = client.get("/plants/export?format=xml", headers=headers)
+    assert response.status_code == 400
+
+
+
+def test_weather_is_cached(client, upstream):
+    """same city twice only calls nominatim and openweathermap once"""
+    assert external_apis.get_weather("Dublin")["temperature"] == 16
+    assert external_apis.get_weather(" dublin")["city"] == "Dublin"
+    assert upstream.count("/search") == 1
+    assert upstream.count("/data/2.5/weather") == 1
+
+
+def test_weather_shared_by_nearby_cities(client, upstream):
+    """two names for the same spot share one weather lookup"""
+    upstream.cities["dublin city"] = (53.3501, -6.2601, "Dublin City, Leinster, Ireland")
+    external_apis.get_weather("Dublin")
+    external_apis.get_weather("Dublin City")
+    assert upstream.count("/search") == 2
+    assert upstream.count("/data/2.5/weather") == 1
+
+
+def test_not_a_city_is_remembered(client, upstream):
+    """a failed geocode is stored in the geocode_cache table"""
+    assert "error" in external_apis.get_weather("blah")
+    external_apis.geocode_cache.clear() # a fresh worker still knows
+    assert "error" in external_apis.get_weather("blah")
+    assert upstream.count("/search") == 1
+    assert db.session.get(GeocodeCache, "blah").found is False
+
+
+def test_outbound_calls_reuse_connections(client, upstream):
+    """image, geocode and weather calls share one kept alive connection"""
+    assert external_apis.get_plant_image("Rose") == "http://img/rose.jpg"
+    assert external_apis.get_plant_image("Daisy") is None
+    assert external_apis.get_weather("Dublin")["temperature"] == 16
+    assert test.city_exists("Dublin")
+    assert upstream.connections == 1
+
+
+def test_outbound_calls_time_out(client, upstream, monkeypatch):
+    """a hung upstream gives up after the read timeout"""
+    monkeypatch.setattr(http_client, "READ_TIMEOUT", 0.1)
+    upstream.delay = 1
+    started = time.monotonic()
+    assert external_apis.get_plant_image("Rose") is None
+    assert "error" in external_apis.get_weather("Dublin")
+    assert time.monotonic() - started < 1
+
+
+
+def test_weather_many(client, upstream):
+    """batch weather returns results and per city errors, each city looked up once"""
+    upstream.cities["cork"] = (51.8985, -8.4756, "Cork, Munster, Ireland")
+    response = client.get("/weather?cities=Dublin,Cork,blah,dublin")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert set(data["weather"]) == {"Dublin", "Cork"}
+    assert list(data["errors"]) == ["blah"]
+    assert upstream.count("/search") == 3
+
+
+def test_weather_many_post(client):
+    """POST form takes a json list of cities"""
+    response = client.post("/weather", json={"cities": ["Dublin"]})
+    assert response.status_code == 200
+    assert response.get_json()["weather"]["Dublin"]["temperature"] == 16
+
+
+def test_weather_many_runs_concurrently(client, upstream):
+    """slow upstream calls overlap instead of queueing"""
+    for i in range(4):
+        upstream.cities[f"town{i}"] = (50 + i, -8, f"Town {i}, Ireland")
+    upstream.delay = 0.3
+    started = time.monotonic()
+    response = client.get("/weather?cities=town0,town1,town2,town3")
+    assert len(response.get_json()["weather"]) == 4
+    assert time.monotonic() - started < 1.5 # 8 calls of 0.3s one after another would be 2.4s
+
+
+def test_weather_many_timeout_returns_promptly(client, upstream):
+    """a city past the timeout is given up on without waiting for its thread"""
+    upstream.delay = 0.5
+    started = time.monotonic()
+    assert external_apis.get_weather_many(["dublin"], timeout=0.1) == {"dublin": {"error": "Timed out fetching weather."}}
+    assert time.monotonic() - started < 0.4 # geocode and weather calls of 0.5s each are still running
+    time.sleep(1.2) # let the abandoned lookup finish before the db is dropped
+
+
+def test_weather_many_no_cities(client):
+    """missing city list is a 400"""
+    assert client.get("/weather").status_code == 400
+    assert client.post("/weather", json={"cities": "Dublin"}).status_code == 400
+
+
+
+def test_get_plant_etag(client, mocker):
+    """matching If-None-Match gets a 304 without an image lookup, an edit changes the etag"""
+    headers = auth(client)
+    add_garden(client, headers)
+    response = client.get("/plants/1", headers=headers)
+    etag = response.headers["ETag"]
+
+    lookup = mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    response = client.get("/plants/1", headers=dict(headers, **{"If-None-Match": etag}))
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert lookup.call_count == 0
+
+    client.put("/plants/1", json={"height": 12}, headers=headers)
+    response = client.get("/plants/1", headers=dict(headers, **{"If-None-Match": etag}))
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_list_plants_etag(client, mocker):
+    """collection etag changes on post, put and delete and depends on the query"""
+    headers = auth(client)
+    add_garden(client, headers)
+
+    def etag_for(query=""):
+        return client.get("/plants" + query, headers=headers).headers["ETag"]
+
+    etag = etag_for()
+    resolve = mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    response = client.get("/plants", headers=dict(headers, **{"If-None-Match": etag}))
+    assert response.status_code == 304
+    assert resolve.call_count == 0
+    assert etag_for("?fields=name") != etag
+
+    client.post("/plants", json={"name": "Fern", "location": "Cork", "date_planted": "01-01-2020"}, headers=headers)
+    after_post = etag_for("?fields=name")
+    client.put("/plants/2", json={"height": 1}, headers=headers)
+    after_put = etag_for("?fields=name")
+    client.delete("/plants/3", headers=headers)
+    after_delete = etag_for("?fields=name")
+    assert len({etag, after_post, after_put, after_delete}) == 4
+
+
+
+def test_storage_pragmas(client):
+    """connections come up in WAL mode with a busy timeout"""
+    with db.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == app.config["SQLITE_BUSY_TIMEOUT"]
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1 # NORMAL
+
+
+def test_reads_use_read_engine(client, mocker):
+    """with SQLITE_READ_ENGINE on, GET /plants reads through the query only engine"""
+    headers = auth(client)
+    add_garden(client, headers)
+    storage.open_read_engine(app)
+    try:
+        reader = storage.read_session()
+        assert reader is not db.session
+        with pytest.raises(Exception, match="readonly"):
+            reader.execute(db.text("DELETE FROM plant"))
+        reader.rollback()
+        assert plant_names(client, headers, {"location": "Dublin"}) == ["Rose", "Lily"]
+        assert client.get("/plants/2", headers=headers).get_json()["name"] == "Rosemary"
+    finally:
+        storage.close_read_engine()
+
+
+
+def test_plants_are_scoped_to_owner(client):
+    """other users cant list, read, edit or delete someone elses plants"""
+    owner = auth(client)
+    add_garden(client, owner)
+    other = auth(client, "otheruser")
+    client.post("/plants", json={"name": "Cactus", "location": "Cork", "date_planted": "01-01-2020"}, headers=other)
+
+    assert plant_names(client, other, {}) == ["Cactus"]
+    assert plant_names(client, other, {"q": "thorny"}) == []
+    assert client.get("/plants/1", headers=other).status_code == 404
+    assert client.put("/plants/1", json={"name": "Mine"}, headers=other).status_code == 404
+    assert client.delete("/plants/1", headers=other).status_code == 404
+    assert plant_names(client, owner, {}) == ["Rose", "Rosemary", "Lily", "Oak"]
+
+
+def test_assign_plants_command(client):
+    """plants without an owner can be handed to a user"""
+    headers = auth(client)
+    db.session.add(Plant(name="Old fern", location="Cork", date_planted=date(2020, 1, 1)))
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=["assign-plants", "testuser"])
+    assert "1 plants now belong to testuser" in result.output
+    assert plant_names(client, headers, {}) == ["Old fern"]
+
+
+
+def metric_value(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_metrics_endpoint(client, upstream):
+    """request, sql and upstream metrics show up in prometheus format"""
+    metrics.registry.clear()
+    headers = auth(client)
+    add_garden(client, headers) # four unsplash calls
+    client.get("/plants/1", headers=headers)
+    upstream.delay = 1
+    http_client.READ_TIMEOUT, old_timeout = 0.1, http_client.READ_TIMEOUT
+    try:
+        external_apis.get_plant_image("Tulip") # one failed call
+    finally:
+        http_client.READ_TIMEOUT = old_timeout
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    assert "# TYPE http_request_duration_seconds histogram" in text
+    assert metric_value(text, 'http_requests_total{endpoint="plantresource",method="POST",status="201"}') == 4
+    assert metric_value(text, 'http_request_duration_seconds_count{endpoint="plantresource",method="GET"}') == 1
+    assert metric_value(text, 'sql_statements_per_request_count{endpoint="plantresource"}') == 5
+    host = upstream.url.split("//")[1]
+    assert metric_value(text, f'upstream_request_duration_seconds_count{{host="{host}"}}') == 5
+    assert metric_value(text, f'upstream_errors_total{{host="{host}"}}') == 1
+
+
+def test_metrics_add_up_workers(client, tmp_path, monkeypatch):
+    """with METRICS_DIR set, /metrics sums every workers file"""
+    metrics.registry.clear()
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    client.get("/")
+    other_worker = metrics.registry.snapshot() # pretend another process handled the same request
+    (tmp_path / "metrics-999999.json").write_text(json.dumps(other_worker))
+
+    text = client.get("/metrics").get_data(as_text=True)
+    assert metric_value(text, 'http_requests_total{endpoint="home",method="GET",status="200"}') == 2
+    assert (tmp_path / f"metrics-{os.getpid()}.json").exists()
+
+
+
+def test_profile_header_only_for_admins(client, tmp_path, monkeypatch):
+    """X-Profile writes a report for admins and is ignored for everyone else"""
+    headers = auth(client)
+    add_garden(client, headers)
+    user_id = User.query.filter_by(username="testuser").first().id
+    monkeypatch.setitem(app.config, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setitem(app.config, "PROFILE_ADMINS", {user_id + 1})
+
+    response = client.get("/plants/1", headers={**headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    assert "X-Profile-Report" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+    monkeypatch.setitem(app.config, "PROFILE_ADMINS", {user_id})
+    response = client.get("/plants/2", headers={**headers, "X-Profile": "1"})
+    report = json.loads((tmp_path / response.headers["X-Profile-Report"]).read_text())
+    assert report["trigger"] == "header"
+    assert report["endpoint"] == "plantresource"
+    assert report["status"] == 200
+    selects = [statement for statement in report["sql"] if statement["statement"].startswith("SELECT")]
+    assert selects and all("plan" in statement for statement in selects)
+    assert any(plan.startswith("SEARCH plant") for statement in selects for plan in statement["plan"])
+    assert report["upstream"] == [] #the image is stored on the plant
+    assert report["functions"] and "_parameters" not in json.dumps(report)
+
+    response = client.post("/plants", json={"name": "Fern", "location": "Cork", "date_planted": "01-01-2025"},
+                           headers={**headers, "X-Profile": "1"})
+    report = json.loads((tmp_path / response.headers["X-Profile-Report"]).read_text())
+    assert [call["url"] for call in report["upstream"]] == [external_apis.UNSPLASH_URL + "/search/photos"]
+
+
+def test_profile_sampling(client, tmp_path, monkeypatch):
+    """every request is profiled at rate 1, none without PROFILE_DIR"""
+    headers = auth(client)
+    add_garden(client, headers)
+    monkeypatch.setitem(app.config, "PROFILE_SAMPLE_RATE", 1)
+    client.get("/plants?fields=name", headers=headers)
+    assert list(tmp_path.iterdir()) == [] #PROFILE_DIR not set
+
+    monkeypatch.setitem(app.config, "PROFILE_DIR", str(tmp_path))
+    response = client.get("/plants?fields=name,image_url", headers=headers)
+    report = json.loads((tmp_path / response.headers["X-Profile-Report"]).read_text())
+    assert report["trigger"] == "sample"
+    assert report["path"] == "/plants?fields=name,image_url"
+    assert report["upstream"] == []
+    assert report["sql_total_ms"] >= 0
+
+
+
+@pytest.fixture
+def hashing(monkeypatch):
+    """hashing settings for one test, put back afterwards"""
+    def configure(**settings):
+        for key, value in settings.items():
+            monkeypatch.setitem(app.config, key, value)
+        hasher.configure(app.config)
+    yield configure
+    monkeypatch.undo()
+    hasher.configure(app.config)
+
+
+def test_login_rehashes_old_cost(client, hashing):
+    """a hash made with another BCRYPT_LOG_ROUNDS is replaced on login"""
+    hashing(BCRYPT_LOG_ROUNDS=5, HASH_WORKERS=1)
+    old_hash = bcrypt_lib.hashpw(b"Password123", bcrypt_lib.gensalt(4)).decode()
+    db.session.add(User(username="old", email="old@test.com", password=old_hash))
+    db.session.commit()
+
+    response = client.post("/login", json={"username": "old", "password": "Password123"})
+    assert response.status_code == 200
+    new_hash = User.query.filter_by(username="old").first().password
+    assert new_hash != old_hash and hash_rounds(new_hash) == 5
+    assert client.post("/login", json={"username": "old", "password": "Password123"}).status_code == 200
+    assert client.post("/login", json={"username": "old", "password": "Wrong123"}).status_code == 401
+
+
+def test_register_hashes_inline_when_no_workers(client, hashing):
+    """HASH_WORKERS=0 hashes in the request thread with the configured cost"""
+    hashing(BCRYPT_LOG_ROUNDS=4, HASH_WORKERS=0)
+    response = client.post("/register", json={"username": "inline", "email": "inline@test.com", "password": "Password123"})
+    assert response.status_code == 201
+    assert hash_rounds(User.query.filter_by(username="inline").first().password) == 4
+    assert client.post("/login", json={"username": "inline", "password": "Password123"}).status_code == 200
+
+
+def test_hashing_saturated_returns_503(client, hashing):
+    """with no hashing slots free login and register answer 503 with Retry-After"""
+    hashing(HASH_MAX_PENDING=0, HASH_RETRY_AFTER=3)
+    response = client.post("/register", json={"username": "busy", "email": "busy@test.com", "password": "Password123"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+    assert User.query.filter_by(username="busy").first() is None
+    auth(client) #user made directly, not through /register
+    response = client.post("/login", json={"username": "testuser", "password": "Password123"})
+    assert response.status_code == 503
+
+
+def test_register_rejects_long_password(client):
+    """bcrypt only takes 72 bytes so longer passwords are refused"""
+    response = client.post("/register", json={"username": "long", "email": "long@test.com", "password": "Aa" * 40})
+    assert response.status_code == 400
+
+
+
+def test_user_lookup_is_cached(client):
+    """authenticated requests read the user from the cache, not the table"""
+    headers = auth(client)
+    assert client.get("/get_user", headers=headers).get_json()["name"] == "testuser"
+
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        response = client.get("/get_user", headers=headers)
+    finally:
+        sqlalchemy.event.remove(db.engine, "before_cursor_execute", record)
+    assert response.get_json()["name"] == "testuser"
+    assert not [statement for statement in statements if "FROM user" in statement]
+
+
+def test_user_cache_dropped_on_write(client):
+    """renaming or deleting a user is seen on the next request"""
+    headers = auth(client)
+    client.get("/get_user", headers=headers)
+    user = User.query.filter_by(username="testuser").first()
+    user.username = "renamed"
+    db.session.commit()
+    assert client.get("/get_user", headers=headers).get_json()["name"] == "renamed"
+
+    db.session.delete(user)
+    db.session.commit()
+    assert client.get("/get_user", headers=headers).status_code == 401
+
+
+
+def test_plant_responses_are_encoded_directly(client, mocker):
+    """single and list responses come from the serializer with every field in order"""
+    mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    headers = auth(client)
+    client.post("/plants", json={"name": "Fuchsia é", "location": "Cork", "date_planted": "01-01-2025", "height": 2}, headers=headers)
+
+    response = client.get("/plants/1", headers=headers)
+    assert response.mimetype == "application/json"
+    assert list(json.loads(response.data)) == ["id", "name", "location", "date_planted", "height", "watered", "notes", "image_url"]
+    assert response.get_json()["name"] == "Fuchsia é"
+
+    response = client.get("/plants?fields=name,height", headers=headers)
+    assert response.data == '{"plants":[{"name":"Fuchsia é","height":2.0}],"next_cursor":null}'.encode()
+
+
+def test_page_encoding_matches_json(client):
+    """encode_plant_page gives the same document json.dumps would"""
+    rows = [Plant(id=1, name="Rose", height=None, watered=True), Plant(id=2, name="Oak", height=3.5, watered=False)]
+    rows[0].image_url = "http://img/rose"
+    body = b"".join(serializer.encode_plant_page(rows, ("id", "name", "image_url"), "abc"))
+    assert json.loads(body) == {"plants": [{"id": 1, "name": "Rose", "image_url": "http://img/rose"},
+                                           {"id": 2, "name": "Oak", "image_url": None}], "next_cursor": "abc"}
+    assert b"".join(serializer.encode_plant_page([], ("id",), None)) == b'{"plants":[],"next_cursor":null}'
+    assert serializer.dumps({"height": float("nan")}) == b'{"height":null}' #valid json, not a bare NaN
+
+
+
+def test_list_is_gzipped(client, mocker):
+    """a big list is gzipped with its own etag and keeps the cors and security headers"""
+    mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    headers = auth(client)
+    add_plants(client, headers, 30)
+    plain = client.get("/plants", headers=headers)
+
+    response = client.get("/plants", headers={**headers, "Accept-Encoding": "gzip, deflate", "Origin": "http://example.com"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert response.headers["Access-Control-Allow-Origin"]
+    assert response.headers["X-Content-Type-Options"] == "nosniff"
+    assert gzip.decompress(response.data) == plain.data
+    assert int(response.headers["Content-Length"]) == len(response.data) < len(plain.data)
+    assert response.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+
+    response = client.get("/plants", headers={**headers, "Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.headers["ETag"].endswith('-gzip"')
+
+
+def test_small_and_unwanted_bodies_not_compressed(client, mocker):
+    """bodies under COMPRESS_MIN_SIZE or without Accept-Encoding are sent as they are"""
+    mocker.patch("external_apis.fetch_plant_image", return_value=None)
+    headers = auth(client)
+    add_plants(client, headers, 1)
+    response = client.get("/plants/1", headers={**headers, "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] and "Accept-Encoding" in response.headers["Vary"]
+    assert response.get_json()["id"] == 1
+    response = client.get("/plants?limit=1", headers={**headers, "Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_streamed_export_is_deflated(client):
+    """the csv export is compressed chunk by chunk"""
+    headers = auth(client)
+    add_plants(client, headers, 50)
+    plain = client.get("/plants/export?format=csv", headers=headers, buffered=True) #buffered so both streams finish in turn
+    response = client.get("/plants/export?format=csv", headers={**headers, "Accept-Encoding": "deflate"}, buffered=True)
+    assert response.headers["Content-Encoding"] == "deflate"
+    assert "Content-Length" not in response.headers
+    assert zlib.decompress(response.data) == plain.data
+
+
+
+def test_image_stored_on_post_and_rename(client, upstream):
+    """post and a rename look the image up once, GET only reads the column"""
+    headers = auth(client)
+    client.post("/plants", json={"name": "Rose", "location": "Cork", "date_planted": "01-01-2025"}, headers=headers)
+    plant = db.session.get(Plant, 1)
+    assert (plant.image_url, plant.image_status) == ("http://img/rose.jpg", "done")
+
+    calls = upstream.count("/search/photos")
+    for _ in range(3):
+        assert client.get("/plants/1", headers=headers).get_json()["image_url"] == "http://img/rose.jpg"
+        assert client.get("/plants", headers=headers).get_json()["plants"][0]["image_url"] == "http://img/rose.jpg"
+    assert upstream.count("/search/photos") == calls
+
+    client.put("/plants/1", json={"height": 3}, headers=headers) #same name, no new lookup
+    assert upstream.count("/search/photos") == calls
+    client.put("/plants/1", json={"name": "Daisy"}, headers=headers)
+    db.session.expire_all()
+    assert (db.session.get(Plant, 1).image_url, db.session.get(Plant, 1).image_status) == (None, "done")
+    assert upstream.count("/search/photos") == calls + 1
+
+
+def test_image_lookup_retries_then_fails(client, mocker):
+    """a lookup that keeps failing is retried and then marked failed"""
+    fetch = mocker.patch("external_apis.fetch_plant_image", side_effect=requests.ConnectionError("down"))
+    headers = auth(client)
+    client.post("/plants", json={"name": "Rose", "location": "Cork", "date_planted": "01-01-2025"}, headers=headers)
+    assert fetch.call_count == app.config["IMAGE_ENRICH_RETRIES"] + 1
+    db.session.expire_all()
+    assert db.session.get(Plant, 1).image_status == "failed"
+
+
+def test_background_worker_backs_off(client, mocker, monkeypatch):
+    """the worker thread retries after the backoff and stores the image"""
+    monkeypatch.setitem(app.config, "IMAGE_ENRICH_INLINE", False)
+    monkeypatch.setitem(app.config, "IMAGE_ENRICH_BACKOFF", 0.05)
+    fetch = mocker.patch("external_apis.fetch_plant_image",
+                         side_effect=[requests.ConnectionError("down"), "http://img/rose.jpg"])
+    headers = auth(client)
+    client.post("/plants", json={"name": "Rose", "location": "Cork", "date_planted": "01-01-2025"}, headers=headers)
+    deadline = time.monotonic() + 5
+    while db.session.get(Plant, 1).image_status != "done" and time.monotonic() < deadline:
+        time.sleep(0.02)
+        db.session.expire_all()
+    assert db.session.get(Plant, 1).image_url == "http://img/rose.jpg"
+    assert fetch.call_count == 2
+
+
+def test_backfill_images_command(client, upstream):
+    """backfill-images fills in plants that were never looked up"""
+    headers = auth(client)
+    user_id = User.query.filter_by(username="testuser").first().id
+    db.session.add_all([Plant(name=name, location="Cork", user_id=user_id) for name in ("Rose", "Rose", "Daisy")])
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=["backfill-images", "--batch-size", "2"])
+    assert "3 plants updated, 0 still without" in result.output
+    assert [plant["image_url"] for plant in client.get("/plants", headers=headers).get_json()["plants"]] == \
+        ["http://img/rose.jpg", "http://img/rose.jpg", None]
+    assert upstream.count("/search/photos") == 2
+
+
+
+def test_date_planted_is_a_date(client):
+    """DD-MM-YYYY and ISO are stored as dates and sent back as DD-MM-YYYY"""
+    headers = auth(client)
+    client.post("/plants", json={"name": "Rose", "location": "Cork", "date_planted": "09-11-2025"}, headers=headers)
+    client.post("/plants", json={"name": "Oak", "location": "Cork", "date_planted": "2024-03-01"}, headers=headers)
+    assert db.session.get(Plant, 1).date_planted == date(2025, 11, 9)
+    assert client.get("/plants/2", headers=headers).get_json()["date_planted"] == "01-03-2024"
+    export = client.get("/plants/export", headers=headers).get_data(as_text=True).splitlines()
+    assert json.loads(export[0])["date_planted"] == "09-11-2025"
+
+    for bad in ("31-02-2025", "9-11-2025", "tomorrow", "2025/11/09"):
+        response = client.post("/plants", json={"name": "Bad", "location": "Cork", "date_planted": bad}, headers=headers)
+        assert response.status_code == 400, bad
+    assert client.put("/plants/1", json={"date_planted": "soon"}, headers=headers).status_code == 400
+    assert client.put("/plants/1", json={"date_planted": "10-11-2025"}, headers=headers).status_code == 200
+    assert client.get("/plants/1", headers=headers).get_json()["date_planted"] == "10-11-2025"
+
+
+def test_planted_between_filter(client):
+    """planted_after and planted_before are inclusive and use the date index"""
+    headers = auth(client)
+    for name, planted in (("Rose", "01-03-2024"), ("Lily", "15-06-2024"), ("Oak", "01-01-2025"), ("Fern", "2025-06-01")):
+        client.post("/plants", json={"name": name, "location": "Cork", "date_planted": planted}, headers=headers)
+    assert plant_names(client, headers, {"planted_after": "2024-06-15"}) == ["Lily", "Oak", "Fern"]
+    assert plant_names(client, headers, {"planted_after": "01-03-2024", "planted_before": "01-01-2025"}) == ["Rose", "Lily", "Oak"]
+    assert client.get("/plants?planted_before=yesterday", headers=headers).status_code == 400
+
+    query = sqlalchemy.select(Plant.id).where(Plant.user_id == 1, *plant_filters({"planted_after": "2024-06-15"}))
+    plan = db.session.execute(sqlalchemy.text("EXPLAIN QUERY PLAN " + str(query.compile(compile_kwargs={"literal_binds": True})))).all()
+    assert "ix_plant_user_date_planted" in " ".join(row[-1] for row in plan)
+
+
+def test_date_planted_migration(client):
+    """old text dates become real dates, text that isnt a date moves to notes"""
+    for name, raw, notes in (("Rose", "09-11-2025", None), ("Lily", "1/2/2024", None), ("Oak", "spring", "big")):
+        db.session.execute(sqlalchemy.text("INSERT INTO plant (name, location, date_planted, notes, version, updated_at, image_status) "
+                                           "VALUES (:name, 'Cork', :raw, :notes, 1, '2025-01-01 00:00:00', 'done')"),
+                           {"name": name, "raw": raw, "notes": notes})
+    db.session.commit()
+    migrations.upgrade_db()
+    db.session.expire_all()
+    plants = db.session.execute(sqlalchemy.select(Plant).order_by(Plant.id)).scalars().all()
+    assert [plant.date_planted for plant in plants] == [date(2025, 11, 9), date(2024, 2, 1), None]
+    assert plants[2].notes == "big\ndate planted: spring"
+    assert plants[0].updated_at.year == 2025 and plants[0].updated_at.month == 1 #served the same as before
+    assert [plant.version for plant in plants] == [1, 2, 2] #lily now reads 01-02-2024, oak lost its date
+    assert plants[1].updated_at.year > 2025 and plants[2].updated_at.year > 2025
+
+
+
+def test_watering_plan(client, upstream):
+    """scores come from one weather lookup per location and are ordered by need"""
+    upstream.cities["cork"] = (51.8985, -8.4756, "Cork, Munster, Ireland")
+    upstream.temperatures["cork"] = 25
+    upstream.descriptions["dublin"] = "light rain"
+    headers = auth(client)
+    today = date.today().strftime("%d-%m-%Y")
+    for name, location, planted, watered in (("Rose", "Cork", "01-01-2020", False), ("Fern", "Cork", today, False),
+                                             ("Oak", "Cork", "01-01-2020", True), ("Lily", "Dublin", "01-01-2020", False),
+                                             ("Ivy", "Atlantis", "01-01-2020", False), ("Mint", "Dublin", today, True)):
+        client.post("/plants", json={"name": name, "location": location, "date_planted": planted, "watered": watered}, headers=headers)
+    weather_calls = upstream.count("/data/2.5/weather")
+
+    data = client.get("/plants/watering-plan", headers=headers).get_json()
+    scores = {plant["name"]: (plant["score"], plant["recommendation"]) for plant in data["plants"]}
+    assert scores == {
+        "Fern": (90.0, "water"), #not watered, hot and just planted
+        "Rose": (70.0, "water"),
+        "Ivy": (40.0, "check"), #no weather for atlantis, counted as mild
+        "Oak": (30.0, "check"),
+        "Lily": (12.0, "skip"), #raining in dublin
+        "Mint": (0.0, "skip"),
+    }
+    assert [plant["name"] for plant in data["plants"]][:2] == ["Fern", "Rose"]
+    assert data["totals"] == {"water": 2, "check": 2, "skip": 2}
+    assert set(data["weather"]) == {"Cork", "Dublin"} and "Atlantis" in data["errors"]
+    assert upstream.count("/data/2.5/weather") - weather_calls == 2 #once per known location
+
+    data = client.get("/plants/watering-plan?location=Cork&limit=1", headers=headers).get_json()
+    assert [plant["name"] for plant in data["plants"]] == ["Fern"]
+    assert data["totals"] == {"water": 2, "check": 1, "skip": 0}
+
+
+
+def sync(client, headers, since=None, **query):
+    response = client.get("/plants/changes", query_string=dict(query, **({"since": since} if since else {})), headers=headers)
+    return response.status_code, response.get_json()
+
+
+def test_changes_since_token(client):
+    """only what changed after the token comes back, deletes as tombstones"""
+    headers = auth(client)
+    other = auth(client, "otheruser")
+    add_garden(client, headers)
+    _, data = sync(client, headers)
+    assert [change["id"] for change in data["changes"]] == [1, 2, 3, 4]
+    assert data["changes"][0]["plant"]["name"] == "Rose" and data["has_more"] is False
+    token = data["token"]
+
+    _, data = sync(client, headers, token)
+    assert data["changes"] == [] and data["token"] == token
+    client.put("/plants/2", json={"height": 9}, headers=headers)
+    client.delete("/plants/3", headers=headers)
+    client.put("/plants/2", json={"height": 10}, headers=headers) #one entry per plant, the latest
+    client.post("/plants", json={"name": "Fern", "location": "Cork", "date_planted": "01-01-2025"}, headers=other)
+
+    _, data = sync(client, headers, token, fields="name,height")
+    assert data["changes"] == [{"id": 3, "deleted": True},
+                               {"id": 2, "deleted": False, "plant": {"name": "Rosemary", "height": 10.0}}]
+    _, first = sync(client, headers, token, limit=1)
+    assert first["has_more"] is True and len(first["changes"]) == 1
+    _, rest = sync(client, headers, first["token"])
+    assert [change["id"] for change in rest["changes"]] == [2]
+
+    assert sync(client, headers, "garbage")[0] == 400
+    plan = db.session.execute(sqlalchemy.text(
+        "EXPLAIN QUERY PLAN SELECT seq FROM plant_change WHERE user_id = 1 AND seq > 3 ORDER BY seq")).all()
+    assert "ix_plant_change_user_seq" in " ".join(row[-1] for row in plan)
+
+
+def test_changes_compaction(client):
+    """old tombstones are compacted and tokens from before them get 410"""
+    headers = auth(client)
+    add_garden(client, headers)
+    _, data = sync(client, headers)
+    old_token = data["token"]
+    client.delete("/plants/1", headers=headers)
+    _, data = sync(client, headers, old_token)
+    new_token = data["token"]
+    assert db.session.query(PlantChange).count() == 7 #create and image update rows for three plants, one tombstone
+
+    result = app.test_cli_runner().invoke(args=["compact-changes", "--days", "0"])
+    assert "1 tombstones removed" in result.output
+    assert db.session.query(PlantChange).count() == 6
+    assert sync(client, headers, old_token)[0] == 410
+    assert sync(client, headers, new_token) == (200, {"changes": [], "token": new_token, "has_more": False})
+    status, data = sync(client, headers) #full sync from the start still works
+    assert status == 200 and [change["id"] for change in data["changes"]] == [2, 3, 4]
+
+
+def test_upgrade_from_first_schema(client):
+    """a plants.db from before users owned plants upgrades on startup and syncs in full"""
+    db.drop_all()
+    with db.engine.begin() as connection: # the tables as the first release made them
+        connection.exec_driver_sql("CREATE TABLE plant (id INTEGER PRIMARY KEY, name VARCHAR(80) NOT NULL, location VARCHAR(120), "
+                                   "date_planted VARCHAR(20), height FLOAT, watered BOOLEAN, notes TEXT)")
+        connection.exec_driver_sql("CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(20) NOT NULL UNIQUE, "
+                                   "email VARCHAR(120) NOT NULL UNIQUE, password VARCHAR(80) NOT NULL)")
+        connection.exec_driver_sql("INSERT INTO plant (name, location, date_planted) VALUES "
+                                   "('Rose', 'Cork', '09-11-2025'), ('Lily', 'Cork', '2024-02-01'), ('Oak', 'Cork', NULL)")
+    db.create_all() # what app.py does on startup
+    migrations.upgrade_db()
+
+    headers = auth(client)
+    result = app.test_cli_runner().invoke(args=["assign-plants", "testuser"])
+    assert "3 plants now belong to testuser" in result.output
+    _, data = sync(client, headers)
+    assert [change["id"] for change in data["changes"]] == [1, 2, 3]
+    assert [change["plant"]["date_planted"] for change in data["changes"]] == ["09-11-2025", "01-02-2024", None]
+
+
+def test_change_log_seeded_for_old_plants(client):
+    """plants missing from the change log show up in a full sync after upgrading, logged ones arent doubled"""
+    headers = auth(client)
+    add_garden(client, headers)
+    db.session.execute(sqlalchemy.delete(PlantChange).where(PlantChange.plant_id.in_([2, 4]))) # only some were logged
+    db.session.commit()
+    migrations.upgrade_db()
+    _, data = sync(client, headers)
+    assert sorted(change["id"] for change in data["changes"]) == [1, 2, 3, 4]
+    assert db.session.query(PlantChange).count() == 6
+
+    db.session.execute(sqlalchemy.delete(PlantChange))
+    db.session.commit()
+    migrations.upgrade_db()
+    _, data = sync(client, headers)
+    assert [change["id"] for change in data["changes"]] == [1, 2, 3, 4]
+
+
+def test_change_log_triggers_replaced(client):
+    """upgrading swaps an older releases plant_change triggers for the current ones"""
+    headers = auth(client)
+    with db.engine.begin() as connection: # the insert trigger before creates were told apart
+        connection.exec_driver_sql("DROP TRIGGER plant_change_insert")
+        connection.exec_driver_sql("""CREATE TRIGGER plant_change_insert AFTER INSERT ON plant BEGIN
+            INSERT INTO plant_change (plant_id, user_id, op) VALUES (new.id, new.user_id, 'upsert');
+        END""")
+    migrations.upgrade_db()
+    migrations.upgrade_db()
+    client.post("/plants", json={"name": "Rose", "location": "Cork", "date_planted": "01-01-2025"}, headers=headers)
+    assert [change.op for change in db.session.query(PlantChange).order_by(PlantChange.seq)] == ["create", "upsert"]
+
+
+
+THREADED = {"wsgi.multithread": True} # what gthread and gevent workers send, the test client says False
+
+
+def next_event(chunks):
+    # next event off an open /plants/stream as a dict of its fields, heartbeats skipped
+    while True:
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if chunk.startswith(":"):
+            continue
+        fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+        if "data" in fields:
+            fields["data"] = json.loads(fields["data"])
+        return fields
+
+
+def test_stream_pushes_changes(client):
+    """creates, updates and deletes reach the owners open stream and nobody elses"""
+    headers = auth(client)
+    other = auth(client, "otheruser")
+    response = client.get("/plants/stream", headers=headers, buffered=False, environ_overrides=THREADED)
+    assert response.status_code == 200 and response.mimetype == "text/event-stream"
+    assert "Content-Encoding" not in response.headers
+    chunks = iter(response.response)
+    assert next_event(chunks) == {"retry": "3000"}
+
+    client.post("/plants", json={"name": "Rose", "location": "Cork", "date_planted": "01-01-2025"}, headers=headers)
+    hub.poll(db.session)
+    event = next_event(chunks)
+    assert event["event"] == "create" and event["data"]["plant"]["name"] == "Rose"
+    event = next_event(chunks) #the image lookup already updated it, that doesnt turn the create into an update
+    assert event["event"] == "update" and event["data"]["id"] == 1
+    client.put("/plants/1", json={"height": 12}, headers=headers)
+    client.post("/plants", json={"name": "Fern", "location": "Cork", "date_planted": "01-01-2025"}, headers=other)
+    client.delete("/plants/1", headers=headers)
+    assert hub.poll(db.session) == 3 #the ferns create and update, the put was replaced by the delete in plant_change
+    event = next_event(chunks)
+    assert event["event"] == "delete" and event["data"] == {"id": 1} and int(event["id"]) > 1
+    assert next(chunks) == b": heartbeat\n\n" #the fern went to nobody
+    response.close()
+    assert hub.subscribers() == 0
+
+
+def test_stream_resume_and_slow_consumer(client):
+    """Last-Event-ID replays what was missed, a client that stops reading is dropped"""
+    headers = auth(client)
+    add_garden(client, headers)
+    first = db.session.query(sqlalchemy.func.max(PlantChange.seq)).filter(PlantChange.plant_id == 1).scalar()
+    response = client.get("/plants/stream", headers=dict(headers, **{"Last-Event-ID": str(first)}), buffered=False, environ_overrides=THREADED)
+    chunks = iter(response.response)
+    next_event(chunks)
+    missed = [next_event(chunks) for _ in range(6)]
+    assert [(event["event"], event["data"]["id"]) for event in missed] == [
+        ("create", 2), ("update", 2), ("create", 3), ("update", 3), ("create", 4), ("update", 4)] #each one was created, then got its image
+
+    app.config["STREAM_QUEUE_SIZE"] = 2
+    try:
+        slow = client.get("/plants/stream", headers=headers, buffered=False, environ_overrides=THREADED)
+        for plant_id in (2, 3, 4):
+            client.put(f"/plants/{plant_id}", json={"height": 5}, headers=headers)
+        hub.poll(db.session)
+    finally:
+        app.config["STREAM_QUEUE_SIZE"] = 100
+    slow_chunks = iter(slow.response)
+    assert next_event(slow_chunks) == {"retry": "3000"}
+    assert next_event(slow_chunks)["event"] == "dropped"
+    assert [next_event(chunks)["data"]["id"] for _ in range(3)] == [2, 3, 4] #the first stream kept up
+    slow.close()
+    response.close()
+    assert hub.subscribers() == 0
+
+    changes.compact(timedelta(0)) #nothing to compact, there are no deletes
+    client.delete("/plants/4", headers=headers)
+    changes.compact(timedelta(0))
+    response = client.get("/plants/stream", headers=dict(headers, **{"Last-Event-ID": str(first)}), buffered=False, environ_overrides=THREADED)
+    chunks = iter(response.response)
+    next_event(chunks)
+    assert next_event(chunks)["event"] == "reload" #what it missed was compacted away
+    response.close()
+    assert client.get("/plants/stream", headers=dict(headers, **{"Last-Event-ID": "abc"}), environ_overrides=THREADED).status_code == 400
+
+
+def test_stream_token_in_query_and_sync_server(client):
+    """EventSource can only send the token as ?jwt=, a sync worker gets 503 instead of a stream"""
+    headers = auth(client)
+    token = headers["Authorization"].split()[1]
+    response = client.get(f"/plants/stream?jwt={token}&last_event_id=0", buffered=False, environ_overrides=THREADED)
+    assert response.status_code == 200
+    assert next_event(iter(response.response)) == {"retry": "3000"}
+    response.close()
+    assert client.get("/plants/stream", environ_overrides=THREADED).status_code == 401
+    assert client.get("/plants", query_string={"jwt": token}).status_code == 401 #only the stream takes it from the url
+    assert client.get("/plants/stream", headers=headers).status_code == 503
+    assert hub.subscribers() == 0
+
+
+
+@pytest.fixture
+def limited(client):
+    """rate limiting on, for the tests of it"""
+    app.config["RATE_LIMIT_ENABLED"] = True
+    yield client
+    app.config["RATE_LIMIT_ENABLED"] = False
+
+
+def test_token_bucket():
+    """a bucket gives out burst tokens at once, then rate a second"""
+    limiter = ratelimit.Limiter()
+    assert [limiter.take("k", 10, 3) for _ in range(3)] == [0, 0, 0]
+    wait = limiter.take("k", 10, 3)
+    assert 0 < wait <= 0.1
+    time.sleep(wait)
+    assert limiter.take("k", 10, 3) == 0
+    assert limiter.take("k", 1, 5, max_wait=2) > 0 #reserved, the caller sleeps for it
+    assert limiter.take("other", 10, 3) == 0
+    assert ratelimit.parse_rate("5:20") == (5.0, 20.0) and ratelimit.parse_rate("off") is None
+    with pytest.raises(ValueError):
+        ratelimit.parse_rate("fast")
+
+
+def test_rate_limit_per_user_and_endpoint(limited):
+    """a user who runs out gets 429 with Retry-After, other users and endpoints dont"""
+    client = limited
+    headers = auth(client)
+    other = auth(client, "otheruser")
+    app.config["RATE_LIMITS"]["plantresource"] = (0.5, 3)
+    try:
+        assert [client.get("/plants", headers=headers).status_code for _ in range(4)] == [200, 200, 200, 429]
+        response = client.get("/plants", headers=headers)
+        assert response.status_code == 429 and response.headers["Retry-After"] == "2"
+        assert client.get("/plants", headers=other).status_code == 200
+        assert client.get("/plants/changes", headers=headers).status_code == 200
+    finally:
+        del app.config["RATE_LIMITS"]["plantresource"]
+    text = client.get("/metrics").get_data(as_text=True)
+    assert metric_value(text, 'rate_limited_total{endpoint="plantresource",scope="user"}') >= 2
+
+
+def test_rate_limit_per_ip(limited, upstream):
+    """requests without a token share their ips bucket, X-Forwarded-For counts behind a proxy"""
+    client = limited
+    statuses = [client.get("/weather/Dublin").status_code for _ in range(11)]
+    assert statuses == [200] * 10 + [429] #weather allows bursts of 10
+    assert client.get("/weather/Dublin", environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code == 200
+    app.config["RATE_LIMIT_PROXIES"] = 1
+    try:
+        forwarded = {"X-Forwarded-For": "203.0.113.9"}
+        assert client.get("/weather/Dublin", headers=forwarded).status_code == 200
+        assert client.get("/weather/Dublin", headers=forwarded).status_code == 200
+    finally:
+        app.config["RATE_LIMIT_PROXIES"] = 0
+
+
+def test_upstream_rate_limit(client, upstream):
+    """calls to an upstream past its quota fail like the upstream was down, the quota isnt spent"""
+    host = upstream.url.split("//")[1] #nominatim and openweathermap are both the fake here
+    upstream.cities["cork"] = (51.8985, -8.4756, "Cork, Munster, Ireland")
+    ratelimit.UPSTREAM_LIMITS[host] = (0.01, 2)
+    try:
+        assert client.get("/weather/Dublin").status_code == 200 #geocode and weather, both tokens
+        assert client.get("/weather/Cork").get_json() == {"error": "Something went wrong, please try again."}
+        assert client.get("/weather/Dublin").status_code == 200 #cached, no upstream call
+    finally:
+        del ratelimit.UPSTREAM_LIMITS[host]
+    assert upstream.count("/search") == 1
+    text = client.get("/metrics").get_data(as_text=True)
+    assert metric_value(text, f'upstream_throttled_total{{host="{host}",outcome="refused"}}') >= 1
+
+
+
+def test_put_and_delete_survive_image_write(client, mocker):
+    """the image worker saving between load and commit doesnt turn a put or delete into a 500"""
+    import app as app_module
+    headers = auth(client)
+    add_garden(client, headers)
+    load = app_module.owned_plant
+
+    def load_then_save(session, plant_id):
+        plant = load(session, plant_id)
+        if plant is not None and owner.call_count == 1: #only the first load is raced
+            with db.engine.begin() as connection:
+                enrichment.save_image(connection, [plant_id], plant.name, "http://img/late.jpg")
+        return plant
+
+    owner = mocker.patch("app.owned_plant", side_effect=load_then_save)
+    response = client.put("/plants/1", json={"height": 42}, headers=headers)
+    assert response.status_code == 200 and owner.call_count == 2
+    db.session.expire_all()
+    plant = db.session.get(Plant, 1)
+    assert plant.height == 42 and plant.image_url == "http://img/late.jpg"
+
+    owner.reset_mock()
+    assert client.delete("/plants/2", headers=headers).status_code == 200
+    assert owner.call_count == 2 and db.session.get(Plant, 2) is None
+
+
+
 
 
 
@@ -0,0 +1,79 @@
+from sqlalchemy import Float, Integer, String, case, column, func, literal, null, select, union_all, values
+from external_apis import city_key, get_weather_many
+from models import Plant
+
+# GET /plants/watering-plan. weather is fetched once per distinct location, sent
+# to sqlite as a VALUES table and joined to the plants, so every score is worked
+# out in one query instead of a python loop over the rows
+
+RAIN_WORDS = ("rain", "drizzle", "shower", "thunderstorm", "snow", "sleet")
+
+WATER_SCORE = 50 #at or above this the plan says water
+CHECK_SCORE = 25 #at or above this it says check the soil
+
+
+def is_raining(weather):
+    return any(word in weather.get("description", "").lower() for word in RAIN_WORDS)
+
+
+def location_weather(locations):
+    # {location: weather or {"error": ...}} for every location, "Cork" and "cork " share one lookup
+    if not locations:
+        return {}
+    by_key = {city_key(name): weather for name, weather in get_weather_many(locations).items()}
+    return {location: by_key[city_key(location)] for location in locations}
+
+
+def weather_table(weather_by_location):
+    # the weather as a VALUES table of (location, temperature, raining) with a row for every location,
+    # temperature is NULL when the weather isnt known. a cte as sqlite cant name VALUES columns inline
+    rows = [(location, None, 0) if "error" in weather else (location, weather["temperature"], int(is_raining(weather)))
+            for location, weather in weather_by_location.items()]
+    return values(
+        column("location", String), column("temperature", Float), column("raining", Integer), name="weather",
+    ).data(rows or [(None, None, 0)]).cte() #a row that matches nothing, sqlite has no empty VALUES
+
+
+def score_expression(temperature, raining):
+    # 0 to 100, higher means the plant needs water sooner. unknown weather counts as 10 degrees and dry
+    age_days = func.julianday("now") - func.julianday(Plant.date_planted) #NULL when the date isnt known
+    score = (
+        case((Plant.watered.is_(True), 0), else_=40) #already watered today
+        + func.max(0, func.min(30, (func.coalesce(temperature, 10) - 10) * 2)) #heat, over 10 degrees
+        + func.min(func.coalesce(Plant.height, 0), 100) * 0.1 #bigger plants drink more
+        + case((age_days < 30, 20), (age_days < 90, 10), else_=0) #young roots dry out fast
+        - case((raining == 1, 40), else_=0)
+    )
+    return func.round(func.max(0, func.min(100, score)), 1)
+
+
+def recommendation_expression(score):
+    return case((score >= WATER_SCORE, literal("water")), (score >= CHECK_SCORE, literal("check")), else_=literal("skip"))
+
+
+def watering_plan(session, filters, limit):
+    # (plants most in need first, totals per recommendation, weather per location)
+    locations = session.execute(
+        select(Plant.location).where(*filters, Plant.location.isnot(None)).distinct() #ix_plant_user_location
+    ).scalars().all()
+    weather_by_location = location_weather(locations)
+    weather = weather_table(weather_by_location)
+
+    columns = (Plant.id, Plant.name, Plant.location, Plant.watered)
+    scores = union_all(
+        # every location has a weather row, so this is an inner join that walks the small
+        # weather table and looks each location up in ix_plant_user_location
+        select(*columns, score_expression(weather.c.temperature, weather.c.raining).label("score"))
+        .select_from(weather).join(Plant, Plant.location == weather.c.location).where(*filters),
+        select(*columns, score_expression(null(), null()).label("score"))
+        .where(*filters, Plant.location.is_(None)),
+    ).subquery()
+    scored = select(scores, recommendation_expression(scores.c.score).label("recommendation")).subquery()
+
+    plants = session.execute(
+        select(scored).order_by(scored.c.score.desc(), scored.c.id).limit(limit)
+    ).all()
+    totals = dict(session.execute(
+        select(scored.c.recommendation, func.count()).group_by(scored.c.recommendation)
+    ).all())
+    return plants, totals, weather_by_location